@@ -0,0 +1,106 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares the cost report aggregation of periodic_costs against the per-row add_cost loop it replaced.
+
+    python benchmarks/bench_costs.py [rows]
+
+Builds synthetic Cost Explorer results (12 months x accounts x services, ~1M rows by default), checks both
+produce identical reports and prints the timings.
+"""
+
+import os
+import random
+import sys
+import time
+from decimal import Decimal, ROUND_HALF_UP
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from eyws.costs import PeriodicCosts, ServiceUsageCost, periodic_costs  # noqa: E402
+
+MONTHS = 12
+SERVICES = 280
+
+
+def synthetic_results(rows):
+    rnd = random.Random(42)
+    accounts = max(1, rows // (MONTHS * SERVICES))
+    account_map = {str(100000000000 + a): "account-{}".format(a) for a in range(accounts)}
+
+    def amount():
+        kind = rnd.random()
+        if kind < 0.05:
+            return "0"
+        if kind < 0.10:
+            return "-{:.10f}".format(rnd.random() / 100)
+        if kind < 0.12:
+            return "{:.2E}".format(rnd.random() / 1000)
+        return "{:.10f}".format(rnd.random() * rnd.choice([1, 10, 1000]))
+
+    results = [{"TimePeriod": {"Start": "2018-{:02d}-01".format(month + 1)},
+                "Groups": [{"Keys": [account_id, "service-{}".format(service)],
+                            "Metrics": {"BlendedCost": {"Amount": amount(), "Unit": "USD"}}}
+                           for account_id in account_map for service in range(SERVICES)]}
+               for month in range(MONTHS)]
+
+    return results, account_map
+
+
+def decimal_costs(results, account_map):
+    """get_costs' original aggregation loop"""
+    costs_by_periods = []
+    for period in results:
+        periodic_cost_info = PeriodicCosts(period["TimePeriod"]["Start"])
+        for service_usage in period["Groups"]:
+            value = Decimal(service_usage["Metrics"]["BlendedCost"]["Amount"])
+            if value != 0:
+                periodic_cost_info.add_cost(ServiceUsageCost(account_map[service_usage["Keys"][0]],
+                                                             service_usage["Keys"][1],
+                                                             value.quantize(Decimal(".01"), rounding=ROUND_HALF_UP),
+                                                             service_usage["Metrics"]["BlendedCost"]["Unit"]))
+        periodic_cost_info.account_service_usage = sorted(periodic_cost_info.account_service_usage.items())
+        costs_by_periods.append(periodic_cost_info)
+    return costs_by_periods
+
+
+def report(costs_by_periods):
+    return [(p.period, str(p.total), sorted((a, str(t)) for a, t in p.account_total.items()),
+             [(a, [(s, str(c), u) for s, c, u in costs]) for a, costs in p.account_service_usage])
+            for p in costs_by_periods]
+
+
+def timed(name, func):
+    start = time.perf_counter()
+    result = func()
+    print("{:<40}{:>8.2f}s".format(name, time.perf_counter() - start))
+    return result
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    results, account_map = synthetic_results(rows)
+    print("{} rows, {} accounts, {} services, {} months\n".format(
+        sum(len(r["Groups"]) for r in results), len(account_map), SERVICES, MONTHS))
+
+    expected = timed("PeriodicCosts.add_cost per row", lambda: decimal_costs(results, account_map))
+    actual = timed("periodic_costs", lambda: periodic_costs(results, account_map))
+
+    if report(expected) != report(actual):
+        sys.exit("reports differ!")
+    print("\nreports are identical")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Measures CLI startup with python -X importtime.
+
+    python benchmarks/bench_startup.py [runs]
+
+Imports eyws.parser and the modules each kind of action loads on top of it in fresh interpreters, prints the
+median import time and the slowest modules of each, and fails if the parser alone imports any of the heavy
+modules actions are supposed to load lazily.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# modules only the actions using them may import
+LAZY_MODULES = ["boto3", "botocore", "jinja2", "smtplib", "email.mime.multipart", "dateutil.relativedelta",
+                "eyws.docker", "asyncio", "sqlite3"]
+
+SCENARIOS = [
+    ("eyws --help", "import eyws.parser"),
+    ("ec2 actions", "import eyws.parser, boto3"),
+    ("list-costs", "import eyws.parser, boto3, dateutil.relativedelta, eyws.accounts, eyws.costs, eyws.coststore"),
+    ("email-costs", "import eyws.parser, boto3, dateutil.relativedelta, eyws.accounts, eyws.costs, eyws.coststore, "
+                    "jinja2, smtplib, email.mime.multipart, email.mime.text"),
+    ("install-docker", "import eyws.parser, boto3, eyws.docker"),
+]
+
+
+def import_times(code):
+    """{module: cumulative microseconds} of a fresh interpreter running code"""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=ROOT,
+                          stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+    return times
+
+
+def top_level_total(times, code):
+    names = code[len("import "):].split(", ")
+    return sum(times.get(name, 0) for name in names)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    for name, code in SCENARIOS:
+        samples = [import_times(code) for _ in range(runs)]
+        total = statistics.median(top_level_total(times, code) for times in samples)
+        print("{:<20}{:>8.1f}ms".format(name, total / 1000))
+        for module, micros in sorted(samples[-1].items(), key=lambda item: -item[1])[:5]:
+            print("    {:<40}{:>8.1f}ms".format(module, micros / 1000))
+
+    eager = [module for module in LAZY_MODULES if module in import_times("import eyws.parser")]
+    if eager:
+        sys.exit("\neyws.parser imports {} at startup!".format(", ".join(eager)))
+    print("\nno heavy module is imported at startup")
+
+
+if __name__ == "__main__":
+    main()
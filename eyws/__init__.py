@@ -13,6 +13,5 @@
 # limitations under the License.
 
 from .about import __version__
-from . import docker
 
 name = "eyws"
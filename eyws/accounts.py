@@ -0,0 +1,94 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from botocore.exceptions import ClientError
+
+ACCOUNTS_CACHE_TTL = 24 * 60 * 60
+
+
+def get_linked_account_names(ce, start, end):
+    """Names of the accounts with usage between start and end, from every page of get_dimension_values"""
+    names = {}
+    token = None
+    while True:
+        if token:
+            kwargs = {"NextPageToken": token}
+        else:
+            kwargs = {}
+
+        resp = ce.get_dimension_values(
+            TimePeriod={
+                "Start": start,
+                "End": end
+            },
+            Dimension="LINKED_ACCOUNT",
+            **kwargs)
+
+        for account_info in resp["DimensionValues"]:
+            names[account_info["Value"]] = account_info["Attributes"]["description"]
+
+        token = resp.get("NextPageToken")
+        if not token:
+            break
+
+    return names
+
+
+def get_organization_account_names(org):
+    """Names of all accounts of the organization, empty if Organizations isn't in use or not permitted"""
+    names = {}
+    try:
+        for page in org.get_paginator("list_accounts").paginate():
+            for account in page["Accounts"]:
+                names[account["Id"]] = account["Name"]
+    except ClientError as e:
+        if e.response["Error"]["Code"] not in ["AWSOrganizationsNotInUseException", "AccessDeniedException"]:
+            raise
+    return names
+
+
+class AccountDirectory:
+    """Account id to name lookup for every linked account.
+
+    Names come from Cost Explorer's LINKED_ACCOUNT dimension merged with organizations:ListAccounts when
+    available, and are cached locally for a day. Unknown ids are looked up as themselves.
+    """
+
+    def __init__(self, names) -> None:
+        self.names = names
+
+    def __getitem__(self, account_id):
+        return self.names.get(account_id, account_id)
+
+    def __contains__(self, account_id):
+        return account_id in self.names
+
+    @classmethod
+    def load(cls, ce, org, cache, account_id, start, end, account_ids=()):
+        """Loads the directory of the payer account_id from the cache.
+
+        It's fetched again when the cached one expired or lacks any of account_ids; ids still unknown after
+        that are remembered as their own names so they don't trigger a fetch every time.
+        """
+        key = ["accounts", account_id]
+        names = cache.get(key, ACCOUNTS_CACHE_TTL)
+
+        if names is None or any(i not in names for i in account_ids):
+            names = get_linked_account_names(ce, start, end)
+            names.update(get_organization_account_names(org))
+            for i in account_ids:
+                names.setdefault(i, i)
+            cache.set(key, names)
+
+        return cls(names)
@@ -0,0 +1,89 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "eyws")
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+
+class Cache:
+    """On-disk JSON cache where every entry is a file named after the hash of its key.
+
+    Entries expire by the ttl given when reading them, counted from when they were written (None never
+    expires). Reading an entry refreshes its file modification time, so when the cache outgrows max_bytes
+    the least recently used entries are evicted first. With refresh=True every read misses and fresh values
+    overwrite the cached ones.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_MAX_BYTES, refresh=False) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.refresh = refresh
+
+    def path(self, key):
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest + ".json")
+
+    def get(self, key, ttl=None):
+        if self.refresh:
+            return None
+
+        path = self.path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+            if ttl is not None and time.time() - entry["created"] > ttl:
+                return None
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return entry["value"]
+
+    def set(self, key, value):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump({"key": key, "created": time.time(), "value": value}, f, default=str)
+            os.replace(tmp, self.path(key))
+            self.evict()
+        except OSError:
+            pass  # caching is best effort
+
+    def get_or_load(self, key, ttl, load):
+        value = self.get(key, ttl)
+        if value is None:
+            value = load()
+            self.set(key, value)
+        return value
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".json"):
+                stat = os.stat(os.path.join(self.directory, name))
+                entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.directory, name))
+            total -= size
@@ -0,0 +1,76 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+
+from eyws.fanout import DEFAULT_PARALLELISM
+
+DEFAULT_API_CONNECT_TIMEOUT = 10
+DEFAULT_API_READ_TIMEOUT = 60
+MAX_API_ATTEMPTS = 10
+RETRY_MODE = "adaptive"  # client side rate limiting on top of retries, backs off when AWS throttles
+
+
+class ClientFactory:
+    """Creates boto3 clients on first use and caches them per (profile, region, service).
+
+    Every client shares one botocore Config: a connection pool as large as the parallelism so concurrent
+    requests don't wait for a connection, adaptive retries and the given timeouts. Sessions aren't thread safe,
+    so clients are created under a lock; the clients themselves can be shared between threads.
+    """
+
+    def __init__(self, region=None, parallelism=DEFAULT_PARALLELISM, connect_timeout=DEFAULT_API_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_API_READ_TIMEOUT) -> None:
+        self.region = region
+        self.parallelism = parallelism
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._config = None
+        self._sessions = {}
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    @property
+    def config(self):
+        if self._config is None:
+            from botocore.config import Config
+
+            self._config = Config(max_pool_connections=max(DEFAULT_PARALLELISM, self.parallelism),
+                                  connect_timeout=self.connect_timeout,
+                                  read_timeout=self.read_timeout,
+                                  retries={"mode": RETRY_MODE, "max_attempts": MAX_API_ATTEMPTS})
+        return self._config
+
+    def session(self, profile=None):
+        """boto3 session of profile, None being the default profile"""
+        with self._lock:
+            return self._session(profile)
+
+    def _session(self, profile):
+        session = self._sessions.get(profile)
+        if session is None:
+            import boto3
+
+            session = self._sessions[profile] = boto3.Session(profile_name=profile, region_name=self.region)
+        return session
+
+    def client(self, service, profile=None, region=None):
+        """Client of service for profile in region, the session's region when None"""
+        key = (profile, region, service)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = self._clients[key] = self._session(profile).client(service, region_name=region,
+                                                                             config=self.config)
+            return client
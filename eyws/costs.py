@@ -0,0 +1,105 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import defaultdict
+from decimal import Decimal, ROUND_HALF_UP
+
+CENT = Decimal(".01")
+
+
+class ServiceUsageCost:
+
+    def __init__(self, account, service_name, cost: Decimal, unit) -> None:
+        self.account = account
+        self.service_name = service_name
+        self.cost = cost
+        self.unit = unit
+
+    def as_tuple(self):
+        return self.service_name, self.cost, self.unit
+
+
+class PeriodicCosts:
+
+    def __init__(self, period) -> None:
+        self.period = period
+        self.account_service_usage = defaultdict(list)  # after sorting => [ ("account XYZ", [(), (), ()]), (...) ]
+        self.total = 0
+        self.account_total = {}
+
+    def add_cost(self, service_usage_cost: ServiceUsageCost):
+        self.account_service_usage[service_usage_cost.account].append(service_usage_cost.as_tuple())
+        self.total += service_usage_cost.cost
+
+        self.account_total[service_usage_cost.account] = service_usage_cost.cost \
+            if service_usage_cost.account not in self.account_total else \
+            self.account_total[service_usage_cost.account] + service_usage_cost.cost
+
+    def rows(self):
+        """(period, account, service, cost, unit) of every service usage cost"""
+        for account, costs in self.account_service_usage:
+            for service_name, cost, unit in costs:
+                yield self.period, account, service_name, cost, unit
+
+    def prettify(self):
+        print("\n{} - {} USD".format(self.period, self.total))
+
+        for account, costs in self.account_service_usage:
+            print("\n\t{}\n".format(account))
+            for service_cost in costs:
+                if service_cost[0]:
+                    print("\t\t{} {}\t{}".format(service_cost[1], service_cost[2], service_cost[0]))
+            print("\t\t------------")
+            print("\t\t{} USD".format(self.account_total[account]))
+
+
+def periodic_costs(results, account_map, by_service=True, label=lambda result: result["TimePeriod"]["Start"]):
+    """One PeriodicCosts per ResultsByTime period, skipping zero amounts; label names each period.
+
+    Every amount is rounded to cents with ROUND_HALF_UP and summed up as Decimal, exactly like add_cost, but in
+    a single pass without a ServiceUsageCost per row and looking up each account's name only once.
+    """
+    costs_by_periods = []
+    names = {}
+
+    for result in results:
+        periodic_cost_info = PeriodicCosts(label(result))
+        usage = defaultdict(list)
+        account_total = periodic_cost_info.account_total
+        total = 0
+
+        for group in result["Groups"]:
+            metric = group["Metrics"]["BlendedCost"]
+            value = Decimal(metric["Amount"])
+            if not value:
+                continue
+            cost = value.quantize(CENT, rounding=ROUND_HALF_UP)
+
+            key = group["Keys"][0]
+            try:
+                account = names[key]
+            except KeyError:
+                account = names[key] = account_map[key]
+
+            usage[account].append((group["Keys"][1] if by_service else None, cost, metric["Unit"]))
+            total += cost
+            previous = account_total.get(account)
+            account_total[account] = cost if previous is None else previous + cost
+
+        periodic_cost_info.total = total
+        # sort usage costs by account
+        periodic_cost_info.account_service_usage = sorted(usage.items())
+        costs_by_periods.append(periodic_cost_info)
+
+    return costs_by_periods
@@ -0,0 +1,147 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from eyws.cache import DEFAULT_CACHE_DIR
+
+DEFAULT_COST_STORE = os.path.join(DEFAULT_CACHE_DIR, "costs.db")
+RESYNC_DAYS = 3  # recent days' costs keep being updated by AWS, fetch them again on every sync
+ROLLUPS = ["month", "week", "day"]
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_costs (
+    account_id TEXT NOT NULL,
+    day TEXT NOT NULL,
+    linked_account TEXT NOT NULL,
+    service TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    unit TEXT NOT NULL,
+    PRIMARY KEY (account_id, day, linked_account, service)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS sync_state (
+    account_id TEXT PRIMARY KEY,
+    synced_until TEXT NOT NULL,
+    synced_from TEXT
+);
+"""
+
+
+class CostStore:
+    """Local SQLite store of daily costs per linked account and service.
+
+    Every account covers one contiguous range of synced days, sync-costs extends it back to the requested start
+    and appends the days since the last sync. Reports are then rolled up locally by month, week or day. Amounts
+    are kept as the exact decimal strings Cost Explorer returns and summed with Decimal.
+    """
+
+    def __init__(self, path=DEFAULT_COST_STORE) -> None:
+        import sqlite3  # ROLLUPS is needed by the option parser of every action, the database only by a few
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript(_SCHEMA)
+        if "synced_from" not in [column[1] for column in self.db.execute("PRAGMA table_info(sync_state)")]:
+            with self.db:  # stores created before synced_from was kept
+                self.db.execute("ALTER TABLE sync_state ADD COLUMN synced_from TEXT")
+
+    def close(self):
+        self.db.close()
+
+    def synced_range(self, account_id):
+        """(first day, day after the last) of the synced days of an account, None when it was never synced"""
+        row = self.db.execute("SELECT synced_from, synced_until FROM sync_state WHERE account_id = ?",
+                              (account_id,)).fetchone()
+        if row is None:
+            return None
+        synced_from, synced_until = row
+        if synced_from is None:
+            synced_from = self.db.execute("SELECT MIN(day) FROM daily_costs WHERE account_id = ?",
+                                          (account_id,)).fetchone()[0] or synced_until
+        return synced_from, synced_until
+
+    def sync_ranges(self, account_id, start, end):
+        """(start, end) ranges to fetch so that the synced days cover start to end.
+
+        Days before the synced ones are backfilled up to the first synced day, keeping the range contiguous,
+        and the last RESYNC_DAYS synced days are fetched again along with the new ones.
+        """
+        synced = self.synced_range(account_id)
+        if synced is None:
+            return [(start, end)]
+
+        synced_from, synced_until = synced
+        ranges = []
+        if start < synced_from:
+            ranges.append((start, synced_from))
+        resync = (datetime.strptime(synced_until, "%Y-%m-%d") - timedelta(days=RESYNC_DAYS)).strftime("%Y-%m-%d")
+        resync = max(resync, synced_from)
+        if resync < end:
+            ranges.append((resync, max(end, synced_until)))
+        return ranges
+
+    def replace_days(self, account_id, start, end, periods):
+        """Replaces all costs between start and end (exclusive) with the given DAILY Cost Explorer periods"""
+        with self.db:
+            self.db.execute("DELETE FROM daily_costs WHERE account_id = ? AND day >= ? AND day < ?",
+                            (account_id, start, end))
+            self.db.executemany("INSERT OR REPLACE INTO daily_costs VALUES (?, ?, ?, ?, ?, ?)",
+                                ((account_id,
+                                  period["TimePeriod"]["Start"],
+                                  group["Keys"][0],
+                                  group["Keys"][1],
+                                  group["Metrics"]["BlendedCost"]["Amount"],
+                                  group["Metrics"]["BlendedCost"]["Unit"])
+                                 for period in periods for group in period["Groups"]))
+            synced_from, synced_until = self.synced_range(account_id) or (start, end)
+            self.db.execute("INSERT OR REPLACE INTO sync_state (account_id, synced_from, synced_until) "
+                            "VALUES (?, ?, ?)", (account_id, min(start, synced_from), max(end, synced_until)))
+
+    def periods(self, account_id, start, end, rollup="month", by_service=True):
+        """Rolls stored daily costs up into Cost Explorer shaped periods, ResultsByTime style"""
+        sums = OrderedDict()
+        units = {}
+
+        for day, linked_account, service, amount, unit in self.db.execute(
+                "SELECT day, linked_account, service, amount, unit FROM daily_costs "
+                "WHERE account_id = ? AND day >= ? AND day < ? ORDER BY day", (account_id, start, end)):
+            period = rollup_period(day, rollup)
+            keys = (linked_account, service) if by_service else (linked_account,)
+            sums.setdefault(period, defaultdict(Decimal))[keys] += Decimal(amount)
+            units[keys] = unit
+
+        return [{"TimePeriod": {"Start": period_start, "End": period_end},
+                 "Groups": [{"Keys": list(keys),
+                             "Metrics": {"BlendedCost": {"Amount": str(amount), "Unit": units[keys]}}}
+                            for keys, amount in groups.items()]}
+                for (period_start, period_end), groups in sums.items()]
+
+
+def rollup_period(day, rollup):
+    """(start, end) of the month, week (starting on Monday) or day containing day"""
+    date = datetime.strptime(day, "%Y-%m-%d")
+    if rollup == "month":
+        start = date.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    elif rollup == "week":
+        start = date - timedelta(days=date.weekday())
+        end = start + timedelta(days=7)
+    else:
+        start = date
+        end = start + timedelta(days=1)
+    return start.strftime("%Y-%m-%d"), end.strftime("%Y-%m-%d")
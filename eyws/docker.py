@@ -12,31 +12,55 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from eyws import ssh
+from eyws import probe, ssh
+from eyws.fanout import DEFAULT_PARALLELISM, fan_out, host_print, print_summary
+from eyws.steps import StepPipeline
+
+DOCKER_INSTALL_STEPS = [
+    "sudo apt-get update",
+    "sudo apt-get install -y apt-transport-https ca-certificates curl software-properties-common",
+    "curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo apt-key add -",
+    "sudo apt-key fingerprint 0EBFCD88",
+    "sudo add-apt-repository \"deb [arch=amd64] https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable\"",
+    "sudo apt-get update",
+    "apt-cache policy docker-ce",
+    "sudo apt-get install -y docker-ce",
+    "sudo usermod -aG docker $USER",
+    "sudo systemctl enable docker"
+]
+
+DOCKER_INSTALL_PIPELINE = StepPipeline("install-docker", DOCKER_INSTALL_STEPS)
 
 
 def install_docker(opts, instances):
-    for res in instances:
-        for instance in res["Instances"]:
-            instance_id = instance["InstanceId"]
-            public_dns = instance["PublicDnsName"]
-            print("installing docker on {id} ({pdns})...".format(id=instance_id, pdns=public_dns))
-            execute(instance, opts, "sudo apt-get update")
-            execute(instance, opts, "sudo apt-get install apt-transport-https ca-certificates curl "
-                                    "software-properties-common")
-            execute(instance, opts, "curl -fsSL https://download.docker.com/linux/ubuntu/gpg | sudo apt-key add -")
-            execute(instance, opts, "sudo apt-key fingerprint 0EBFCD88")
-            execute(instance, opts, "sudo add-apt-repository \"deb [arch=amd64] "
-                                    "https://download.docker.com/linux/ubuntu $(lsb_release -cs) stable\"")
-            execute(instance, opts, "sudo apt-get update")
-            execute(instance, opts, "apt-cache policy docker-ce")
-            execute(instance, opts, "sudo apt-get install docker-ce")
-            execute(instance, opts, "sudo usermod -aG docker $USER")
-            execute(instance, opts, "sudo systemctl enable docker")
-            print("docker installed on {id} ({pdns})".format(id=instance_id, pdns=public_dns))
-
-
-def execute(instance, opts, cmnd):
-    ssh(host=instance["PublicDnsName"],
-        opts=opts,
-        command=cmnd)
+    hosts = {instance["InstanceId"]: instance for instance in instances}
+    readiness = {}
+
+    def ready_hosts():
+        # hand each host over to the workers as soon as its sshd accepts connections
+        for instance_id, ready in probe.as_ready(hosts,
+                                                 address=lambda i: hosts[i]["PublicDnsName"],
+                                                 timeout=opts.ssh_max_wait):
+            readiness[instance_id] = ready
+            yield instance_id
+
+    def install(instance_id):
+        instance = hosts[instance_id]
+        if not readiness[instance_id]:
+            raise Exception("{} is not accepting SSH connections after {} seconds".format(instance["PublicDnsName"],
+                                                                                        opts.ssh_max_wait))
+        install_docker_on(opts, instance)
+
+    succeeded, failed = fan_out(install, ready_hosts(), workers=opts.parallel or DEFAULT_PARALLELISM)
+    print_summary(succeeded, failed)
+
+    if failed:
+        raise Exception("docker installation failed on {} of {} instances".format(len(failed), len(hosts)))
+
+
+def install_docker_on(opts, instance):
+    """Installs docker on a single instance that accepts SSH connections"""
+    host_print(instance["InstanceId"], "installing docker on {}...".format(instance["PublicDnsName"]))
+    with ssh.Session(instance["PublicDnsName"], opts, prefix=instance["InstanceId"]) as session:
+        DOCKER_INSTALL_PIPELINE.run(session)
+    host_print(instance["InstanceId"], "docker installed on {}".format(instance["PublicDnsName"]))
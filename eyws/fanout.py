@@ -0,0 +1,57 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_PARALLELISM = 10
+
+_print_lock = threading.Lock()
+
+
+def host_print(host, line, file=None):
+    with _print_lock:
+        print("[{}] {}".format(host, line), file=file if file else sys.stdout, flush=True)
+
+
+def fan_out(task, hosts, workers=DEFAULT_PARALLELISM):
+    """Run task(host) for every host on a bounded pool of workers.
+
+    Returns a (succeeded, failed) tuple; failed holds (host, exception) pairs.
+    """
+    succeeded = []
+    failed = []
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(task, host): host for host in hosts}
+        for future in as_completed(futures):
+            host = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                host_print(host, "failed: {}".format(e), file=sys.stderr)
+                failed.append((host, e))
+            else:
+                succeeded.append(host)
+
+    return succeeded, failed
+
+
+def print_summary(succeeded, failed):
+    print("\n{} succeeded, {} failed".format(len(succeeded), len(failed)))
+    for host in sorted(succeeded):
+        print("\tok\t{}".format(host))
+    for host, e in sorted(failed, key=lambda f: f[0]):
+        print("\tfailed\t{}\t{}".format(host, e))
@@ -0,0 +1,203 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import statistics
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from eyws import probe
+from eyws.fanout import DEFAULT_PARALLELISM, host_print
+from eyws.waiter import DEFAULT_WAIT_INTERVAL, DEFAULT_WAIT_TIMEOUT, WAITERS
+
+STAGES = ["launched", "tagged", "running", "ssh-ready", "provisioned"]
+
+
+class FleetInstance:
+    """An instance moving through STAGES, with the seconds it took to reach each of them since launch"""
+
+    def __init__(self, index, instance) -> None:
+        self.index = index
+        self.instance = instance
+        self.instance_id = instance["InstanceId"]
+        self.state = instance.get("State", {}).get("Name", "pending")
+        self.times = OrderedDict([(STAGES[0], 0.0)])
+        self.error = None
+
+    @property
+    def stage(self):
+        return next(reversed(self.times))
+
+    def reached(self, stage, started):
+        self.times[stage] = time.monotonic() - started
+        host_print(self.instance_id, "{} after {:.1f}s".format(stage, self.times[stage]))
+
+    def failed(self, e):
+        self.error = e
+        host_print(self.instance_id, "failed while {}: {}".format(self.stage, e), file=sys.stderr)
+
+
+class Fleet:
+    """Brings launched instances up, each one on its own as fast as it can go.
+
+    Every instance is tagged, waited for until it's running, probed until it accepts SSH connections and
+    provisioned independently of the others, so one slow instance doesn't hold the rest back. Instances waiting
+    to run are polled together once per interval, through the instance_running waiter's states.
+
+    tag(index, instance) and provision(instance) are optional steps. states(instance_ids) returns the state names
+    of the given instances, like waiter.visible_states, describe(instance_ids) their descriptions once running.
+    wait=False stops once instances are tagged. Instances not running timeout seconds after the launch fail.
+    """
+
+    def __init__(self, instances, states, describe, tag=None, provision=None, wait=True, workers=DEFAULT_PARALLELISM,
+                 interval=DEFAULT_WAIT_INTERVAL, ssh_max_wait=probe.DEFAULT_PROBE_TIMEOUT,
+                 timeout=DEFAULT_WAIT_TIMEOUT) -> None:
+        self.members = [FleetInstance(i, instance) for i, instance in enumerate(instances)]
+        self.states = states
+        self.describe = describe
+        self.tag = tag
+        self.provision = provision
+        self.wait = wait or provision is not None
+        self.workers = workers
+        self.interval = interval
+        self.ssh_max_wait = ssh_max_wait
+        self.timeout = timeout
+        self.started = time.monotonic()
+
+        self.pool = None
+        self._changed = threading.Condition()
+        self._tagging = 0
+        self._waiting = {}
+
+    @property
+    def target(self):
+        if self.provision:
+            return STAGES[-1]
+        return "running" if self.wait else "tagged"
+
+    def run(self):
+        """Runs every instance up to the target stage, returns (succeeded, failed) FleetInstances"""
+        self.started = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+            self.pool = pool
+            for member in self.members:
+                if self.tag:
+                    with self._changed:
+                        self._tagging += 1
+                    pool.submit(self._tag, member)
+                else:
+                    self._tagged(member)
+
+            self._poll()
+
+        succeeded = [member for member in self.members if member.error is None]
+        failed = [member for member in self.members if member.error is not None]
+        return succeeded, failed
+
+    def _tag(self, member):
+        try:
+            self.tag(member.index, member.instance)
+        except Exception as e:
+            member.failed(e)
+        else:
+            member.reached("tagged", self.started)
+            self._tagged(member)
+        finally:
+            with self._changed:
+                self._tagging -= 1
+                self._changed.notify()
+
+    def _tagged(self, member):
+        if member.times.get("tagged") is None:
+            member.times["tagged"] = member.times["launched"]  # tagged at launch
+        if self.wait:
+            with self._changed:
+                self._waiting[member.instance_id] = member
+                self._changed.notify()
+
+    def _poll(self):
+        """Polls instances waiting to run until none is left, handing running ones over to provisioning"""
+        last_poll = time.monotonic()
+        deadline = self.started + self.timeout
+        while True:
+            with self._changed:
+                while not self._waiting and self._tagging:
+                    self._changed.wait()
+                if not self._waiting:
+                    return
+                if time.monotonic() >= deadline:
+                    for member in self._waiting.values():
+                        member.failed(Exception("instance is still {} after {} seconds"
+                                                .format(member.state, self.timeout)))
+                    self._waiting.clear()
+                    continue  # instances still being tagged fail on the next round
+                next_poll = min(last_poll + self.interval, deadline)
+                while time.monotonic() < next_poll:
+                    self._changed.wait(next_poll - time.monotonic())
+                waiting = dict(self._waiting)
+
+            last_poll = time.monotonic()
+            target, failure_states = WAITERS["instance_running"]
+            states = self.states(list(waiting))
+            for instance_id, state in states.items():
+                waiting[instance_id].state = state
+
+            running = [instance_id for instance_id, state in states.items() if state == target]
+            described = set()
+            if running:
+                for instance in self.describe(running):  # public DNS names are known once running
+                    member = waiting[instance["InstanceId"]]
+                    member.instance = instance
+                    member.reached("running", self.started)
+                    described.add(member.instance_id)
+
+            for instance_id, state in states.items():
+                member = waiting[instance_id]
+                if state in failure_states:
+                    member.failed(Exception("instance is {}".format(state)))
+                elif instance_id not in described:
+                    continue
+
+                with self._changed:
+                    del self._waiting[instance_id]
+                if member.error is None and self.provision:
+                    self.pool.submit(self._provision, member)
+
+    def _provision(self, member):
+        dns = member.instance["PublicDnsName"]
+        try:
+            if not probe.wait_for(dns, timeout=self.ssh_max_wait):
+                raise Exception("{} is not accepting SSH connections after {} seconds".format(dns, self.ssh_max_wait))
+            member.reached("ssh-ready", self.started)
+            self.provision(member.instance)
+            member.reached("provisioned", self.started)
+        except Exception as e:
+            member.failed(e)
+
+    def print_report(self):
+        stages = STAGES[:STAGES.index(self.target) + 1]
+        print("\n{:<22}".format("instance") + "".join("{:>13}".format(stage) for stage in stages))
+        for member in self.members:
+            print("{:<22}".format(member.instance_id) +
+                  "".join("{:>13}".format("{:.1f}s".format(member.times[stage]) if stage in member.times else "-")
+                          for stage in stages) +
+                  ("  failed: {}".format(member.error) if member.error else ""))
+
+        done = [member.times[self.target] for member in self.members if self.target in member.times]
+        if done:
+            print("\n{} of {} instances {} in {:.1f}s, median {:.1f}s".format(
+                len(done), len(self.members), self.target, max(done), statistics.median(done)))
@@ -0,0 +1,97 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+import sys
+from collections import OrderedDict
+
+OUTPUT_FORMATS = ["text", "jsonl", "csv", "table"]
+DEFAULT_OUTPUT_FORMAT = OUTPUT_FORMATS[0]
+
+
+def select_fields(fields, columns=None):
+    """[(name, getter)] of the given columns of fields, all of them when columns is empty"""
+    if not columns:
+        return list(fields.items())
+
+    unknown = [column for column in columns if column not in fields]
+    if unknown:
+        raise ValueError("Unknown columns {}, choose from {}".format(unknown, list(fields)))
+
+    return [(column, fields[column]) for column in columns]
+
+
+def render(items, fields, output=DEFAULT_OUTPUT_FORMAT, columns=None, text=print, file=None):
+    """Prints items one record at a time.
+
+    fields maps column names to getters of an item, only the getters of the selected columns are called. text
+    prints an item in the default human readable format. jsonl and csv records are written as soon as their item
+    is produced, table has to see every record to align its columns.
+    """
+    if output == "text":
+        for item in items:
+            text(item)
+        return
+
+    selected = select_fields(fields, columns)
+    file = file or sys.stdout
+
+    if output == "jsonl":
+        for item in items:
+            file.write(json.dumps(OrderedDict((name, get(item)) for name, get in selected), default=_scalar) + "\n")
+    elif output == "csv":
+        writer = csv.writer(file)
+        writer.writerow([name for name, _ in selected])
+        for item in items:
+            writer.writerow([_cell(get(item)) for _, get in selected])
+    elif output == "table":
+        rows = [[name for name, _ in selected]]
+        rows.extend([_cell(get(item)) for _, get in selected] for item in items)
+        widths = [max(len(row[i]) for row in rows) for i in range(len(selected))]
+        for row in rows:
+            file.write("  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip() + "\n")
+    else:
+        raise ValueError("Unknown output format '{}', choose from {}".format(output, OUTPUT_FORMATS))
+
+
+def lookup(record, path):
+    """Value at the dotted path of a record, i.e. State.Name or Tags.0.Value, None when it's missing"""
+    value = record
+    for key in path.split("."):
+        try:
+            value = value[int(key)] if isinstance(value, list) else value[key]
+        except (KeyError, IndexError, TypeError, ValueError):
+            return None
+    return value
+
+
+def print_values(values, file=None):
+    """Prints values tab separated on one line"""
+    print("\t".join(_cell(value) for value in values), file=file or sys.stdout)
+
+
+def _cell(value):
+    if value is None:
+        return ""
+    if isinstance(value, (list, dict, tuple)):
+        return json.dumps(value, default=_scalar)
+    return _scalar(value)
+
+
+def _scalar(value):
+    """JSON and CSV form of values like datetimes and Decimal costs"""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
@@ -12,23 +12,28 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+# boto3, jinja2, email and the docker provisioning modules take most of the startup time, they are imported
+# by the actions using them so that --help or an action like list-regions doesn't pay for all of them
 import os
-import smtplib
+import queue
+import random
 import sys
+import threading
 import time
-from collections import defaultdict
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from decimal import Decimal, ROUND_HALF_UP
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
 from optparse import OptionParser
 
-import boto3
-from botocore.exceptions import ClientError
-from dateutil.relativedelta import relativedelta
-from jinja2 import Environment, FileSystemLoader
-
 from eyws import __version__
+from eyws.cache import Cache
+from eyws.clients import DEFAULT_API_CONNECT_TIMEOUT, DEFAULT_API_READ_TIMEOUT, ClientFactory
+from eyws.coststore import ROLLUPS
+from eyws.fanout import DEFAULT_PARALLELISM
+from eyws.output import DEFAULT_OUTPUT_FORMAT, OUTPUT_FORMATS, lookup, print_values, render, select_fields
+from eyws.server import DEFAULT_SOCKET
+from eyws.waiter import DEFAULT_WAIT_INTERVAL
+from eyws.ssh import DEFAULT_SSH_MAX_WAIT, DEFAULT_SSH_TIMEOUT
 
 UBUNTU_AMI = "ami-de8fb135"  # Ubuntu Server 16.04 LTS SSD
 DEFAULT_AMI = UBUNTU_AMI
@@ -42,6 +47,77 @@ DEFAULT_EBS_VOLUME_NAME = "/dev/sda1"
 DEFAULT_NUM_OF_MONTHS_TO_CHECK_COST = 1  # current month
 DEFAULT_COST_METRICS_TYPE = "BlendedCost"
 DEFAULT_COST_EMAIL_SUBJECT = "AWS Usage Costs"
+COST_FINALIZATION_DAYS = 5  # days after a month ends until its costs are final
+MAX_API_RETRIES = 6
+MAX_API_RETRY_DELAY = 20
+DESCRIBE_INSTANCES_PAGE_SIZE = 1000
+REGION_BUFFER_SIZE = DESCRIBE_INSTANCES_PAGE_SIZE  # instances fetched ahead per region while another is printed
+REGIONS_CACHE_TTL = 7 * 24 * 60 * 60
+ZONES_CACHE_TTL = 24 * 60 * 60
+IMAGES_CACHE_TTL = 24 * 60 * 60
+KEY_PAIRS_CACHE_TTL = 15 * 60
+
+EC2_ACTIONS = ["create-instances", "stop-instances", "start-instances", "terminate-instances", "list-instances",
+               "list-zones", "list-regions", "list-images", "list-sec-groups", "list-key-pairs", "install-docker",
+               "exec", "push"]
+
+# columns of --output jsonl, csv and table records
+INSTANCE_FIELDS = OrderedDict([
+    ("region", lambda item: item[0]),
+    ("instance_id", lambda item: item[1]["InstanceId"]),
+    ("image_id", lambda item: item[1]["ImageId"]),
+    ("state", lambda item: item[1]["State"]["Name"]),
+    ("state_message", lambda item: item[1].get("StateTransitionReason")),
+    ("type", lambda item: item[1]["InstanceType"]),
+    ("key_name", lambda item: item[1].get("KeyName")),
+    ("launch_time", lambda item: item[1].get("LaunchTime")),
+    ("monitoring", lambda item: item[1]["Monitoring"]["State"]),
+    ("zone", lambda item: item[1]["Placement"]["AvailabilityZone"]),
+    ("private_dns", lambda item: item[1].get("PrivateDnsName")),
+    ("private_ip", lambda item: item[1].get("PrivateIpAddress")),
+    ("public_dns", lambda item: item[1].get("PublicDnsName")),
+    ("public_ip", lambda item: item[1].get("PublicIpAddress")),
+    ("subnet_id", lambda item: item[1].get("SubnetId")),
+    ("vpc_id", lambda item: item[1].get("VpcId")),
+    ("tags", lambda item: {tag["Key"]: tag["Value"] for tag in item[1].get("Tags", [])}),
+    ("core_count", lambda item: item[1].get("CpuOptions", {}).get("CoreCount")),
+    ("threads_per_core", lambda item: item[1].get("CpuOptions", {}).get("ThreadsPerCore")),
+    ("security_groups", lambda item: item[1].get("SecurityGroups"))])
+SECURITY_GROUP_FIELDS = OrderedDict([
+    ("group_name", lambda sec_group: sec_group["GroupName"]),
+    ("group_id", lambda sec_group: sec_group["GroupId"]),
+    ("description", lambda sec_group: sec_group["Description"]),
+    ("vpc_id", lambda sec_group: sec_group.get("VpcId")),
+    ("ip_permissions", lambda sec_group: sec_group["IpPermissions"])])
+REGION_FIELDS = OrderedDict([("region", lambda region: region)])
+ZONE_FIELDS = OrderedDict([("zone", lambda zone: zone)])
+KEY_PAIR_FIELDS = OrderedDict([("key_name", lambda key_pair: key_pair)])
+IMAGE_FIELDS = OrderedDict([("name", lambda image: image[0]), ("image_id", lambda image: image[1])])
+COST_FIELDS = OrderedDict((name, lambda row, i=i: row[i])
+                          for i, name in enumerate(["period", "account", "service", "cost", "unit"]))
+EXEC_FIELDS = OrderedDict([
+    ("instance_id", lambda result: result.instance_id),
+    ("host", lambda result: result.host),
+    ("exit_code", lambda result: result.exit_code),
+    ("seconds", lambda result: round(result.seconds, 3)),
+    ("stdout", lambda result: result.stdout),
+    ("stderr", lambda result: result.stderr)])
+ACTION_FIELDS = {"list-instances": INSTANCE_FIELDS, "list-sec-groups": SECURITY_GROUP_FIELDS,
+                 "list-regions": REGION_FIELDS, "list-zones": ZONE_FIELDS, "list-key-pairs": KEY_PAIR_FIELDS,
+                 "list-images": IMAGE_FIELDS, "list-costs": COST_FIELDS, "exec": EXEC_FIELDS}
+
+INSTANCE_STATES = ["pending", "running", "shutting-down", "terminated", "stopping", "stopped"]
+
+STATE_CHANGE_CHUNK_SIZE = 100  # instance ids per stop/start/terminate call
+# change => (ec2 method, response key, states the change applies to, waiter of the resulting state)
+STATE_CHANGES = {
+    "stop": ("stop_instances", "StoppingInstances", ["pending", "running"], "instance_stopped"),
+    "start": ("start_instances", "StartingInstances", ["stopped"], "instance_running"),
+    "terminate": ("terminate_instances", "TerminatingInstances", ["pending", "running", "stopping", "stopped"],
+                  "instance_terminated"),
+}
+STATE_CHANGE_PARTICIPLES = {"stop": ("Stopping", "stopped"), "start": ("Starting", "started"),
+                            "terminate": ("Terminating", "terminated")}
 
 EBS_VOLUME_TYPES = [("standard", "Magnetic"),
                     ("io1", "Provisioned IOPS SSD"),
@@ -50,8 +126,8 @@ EBS_VOLUME_TYPES = [("standard", "Magnetic"),
                     ("st1", "Throughput Optimized HDD")]
 
 
-def parse_args():
-    parser = OptionParser(usage="eyws <action> [options]\n\n<action> can be:\n\t\t"
+def parse_args(argv=None):
+    parser = OptionParser(usage="eyws <action> [options] [-- command | source destination]\n\n<action> can be:\n\t\t"
                                 "create-instances\n\t\t"
                                 "stop-instances\n\t\t"
                                 "terminate-instances\n\t\t"
@@ -63,26 +139,51 @@ def parse_args():
                                 "list-key-pairs\n\t\t"
                                 "list-costs\n\t\t"
                                 "email-costs\n\t\t"
-                                "install-docker",
+                                "sync-costs\n\t\t"
+                                "install-docker\n\t\t"
+                                "exec\n\t\t"
+                                "push\n\t\t"
+                                "serve",
+                          prog="eyws",
                           version="%prog-{}".format(__version__),
                           add_help_option=False)
 
     parser.add_option("-h", "--help", action="help",
                       help="Show this help message and exit")
 
-    parser.add_option("-p", "--profile", help="aws profile to use (~/.aws/config) (default=default profile)")
+    parser.add_option("-p", "--profile",
+                      help="aws profile to use (~/.aws/config), list-costs and email-costs accept comma separated "
+                           "profiles to report costs of several accounts at once (default=default profile)")
 
     parser.add_option("-c", "--count", metavar="Instance Count", type="int", default=DEFAULT_NUM_OF_INSTANCES,
                       help="Number of instances to launch (default={})".format(DEFAULT_NUM_OF_INSTANCES))
 
     parser.add_option("-n", "--name", metavar="Name Tag", dest="name_tag", help="Append a name tag to instances")
 
-    parser.add_option("-t", "--instance-type", metavar="Instance Type", default=DEFAULT_INSTANCE_TYPE,
-                      help="Type of instances to launch (default={})".format(DEFAULT_INSTANCE_TYPE))
+    parser.add_option("-t", "--instance-type", metavar="Instance Type",
+                      help="Type of instances to launch (default={}), or to list, stop, start, terminate, exec on or "
+                           "push to only instances of this type".format(DEFAULT_INSTANCE_TYPE))
+
+    parser.add_option("--state", metavar="State", action="append", dest="states", choices=INSTANCE_STATES,
+                      help="List, stop, start, terminate, exec on or push to only instances in this state, can be "
+                           "repeated. One of {}".format(INSTANCE_STATES))
+
+    parser.add_option("--tag", metavar="Key=Value", action="append", dest="tags",
+                      help="List, stop, start, terminate, exec on or push to only instances tagged with Key=Value "
+                           "(* matches any characters), or having a Key tag. Can be repeated, values of the same "
+                           "key match any of them")
+
+    parser.add_option("--query", action="callback", callback=split_commas, dest="query", type="string",
+                      help="Comma separated dotted fields of instances to list instead of all of them "
+                           "i.e. InstanceId,State.Name,Tags.0.Value")
 
     parser.add_option("-r", "--region", metavar="Region",
                       help="EC2 region to list and launch instances in (default=.aws/config)")
 
+    parser.add_option("--all-regions", action="store_true", default=False,
+                      help="List, stop, start, terminate, exec on or push to instances of all regions instead of "
+                           "--region, can't be combined with --instance-id")
+
     parser.add_option("-z", "--zone", metavar="Zone", default="",
                       help="Availability zone to list and launch instances in (default=random when launching instances)")
 
@@ -95,6 +196,21 @@ def parse_args():
 
     parser.add_option("-u", "--user", help="SSH user to connect as to instances")
 
+    parser.add_option("--ssh-timeout", metavar="Seconds", type="int", default=DEFAULT_SSH_TIMEOUT,
+                      help="Seconds to wait for each SSH connection attempt (default={})".format(DEFAULT_SSH_TIMEOUT))
+
+    parser.add_option("--ssh-max-wait", metavar="Seconds", type="int", default=DEFAULT_SSH_MAX_WAIT,
+                      help="Seconds to keep retrying SSH connections to an instance (default={})"
+                      .format(DEFAULT_SSH_MAX_WAIT))
+
+    parser.add_option("--host-timeout", metavar="Seconds", type="int", default=0,
+                      help="Seconds a command run by exec or a copy by push may take on each instance before it's "
+                           "killed (default=no limit)")
+
+    parser.add_option("--relay", action="store_true", default=False,
+                      help="Let instances that received the files of push copy them on to the others over private "
+                           "IPs, needs an ssh-agent holding the identity")
+
     parser.add_option("-e", "--ebs-vol-size", dest="ebs_vol_size", metavar="Size", type="int",
                       default=DEFAULT_EBS_VOLUME_SIZE,
                       help="EBS volume size in GB to attach each instance (default={})".format(DEFAULT_EBS_VOLUME_SIZE))
@@ -117,7 +233,7 @@ def parse_args():
                       help="Security Group name to use for launching instances")
 
     parser.add_option("--instance-id", metavar="instance Id", action="append", dest="instance_ids",
-                      help="instance id to start/stop/destroy/install")
+                      help="instance id to start/stop/destroy/install/exec/push")
 
     parser.add_option("--days", type="int", help="Usage cost charged since <days> days")
 
@@ -127,7 +243,24 @@ def parse_args():
     parser.add_option("--ignore-service-usage", action="store_true",
                       help="Do not display costs for each service type")
 
-    parser.add_option("--emails", action="callback", callback=split_emails, dest="emails", type="string",
+    parser.add_option("--local", action="store_true", default=False,
+                      help="Report costs from the local store filled by sync-costs instead of Cost Explorer")
+
+    parser.add_option("--rollup", choices=ROLLUPS, default=ROLLUPS[0],
+                      help="Period to sum up local costs by, one of {} (default={})".format(ROLLUPS, ROLLUPS[0]))
+
+    parser.add_option("--merge", action="store_true", default=False,
+                      help="Merge costs of all profiles into one report instead of one per profile")
+
+    parser.add_option("--output", choices=OUTPUT_FORMATS, default=DEFAULT_OUTPUT_FORMAT,
+                      help="Output format of list and exec actions, one of {}. jsonl and csv stream a record per line "
+                           "(default={})".format(OUTPUT_FORMATS, DEFAULT_OUTPUT_FORMAT))
+
+    parser.add_option("--columns", action="callback", callback=split_commas, dest="columns", type="string",
+                      help="Comma separated columns of jsonl, csv and table output i.e. instance_id,state,public_ip "
+                           "(default=all)")
+
+    parser.add_option("--emails", action="callback", callback=split_commas, dest="emails", type="string",
                       help="Comma separated (without space) email addresses to notify i.e. can@x.com,b@y.com")
 
     parser.add_option("--template", help="Jinja template file")
@@ -138,37 +271,171 @@ def parse_args():
 
     parser.add_option("--smtp-from", help="Sender email address")
 
+    parser.add_option("--refresh", action="store_true", default=False,
+                      help="Bypass the local cache (~/.cache/eyws) and refresh it from AWS")
+
     parser.add_option("--dry-run", action="store_true", help="Dry run operations", default=False)
 
+    parser.add_option("-y", "--yes", action="store_true", default=False,
+                      help="Do not ask for confirmation before stopping or terminating instances")
+
     parser.add_option("--install-docker", action="store_true", help="Install Docker on instances", default=False)
 
     parser.add_option("--do-not-wait", action="store_false", dest="wait",
                       help="Do not wait until instances are fully up and running",
                       default=True)
 
-    (opts, args) = parser.parse_args()
+    parser.add_option("--wait", action="store_true", dest="wait_state", default=False,
+                      help="Wait until started, stopped or terminated instances reach their new state")
+
+    parser.add_option("--wait-interval", metavar="Seconds", type="float", default=DEFAULT_WAIT_INTERVAL,
+                      help="Seconds between checks of instance states while waiting (default={})"
+                      .format(DEFAULT_WAIT_INTERVAL))
+
+    parser.add_option("--parallel", metavar="N", type="int", default=DEFAULT_PARALLELISM,
+                      help="Number of instances or regions to work on concurrently (default={})"
+                      .format(DEFAULT_PARALLELISM))
+
+    parser.add_option("--api-connect-timeout", metavar="Seconds", type="int", default=DEFAULT_API_CONNECT_TIMEOUT,
+                      help="Seconds to wait for connecting to AWS APIs (default={})"
+                      .format(DEFAULT_API_CONNECT_TIMEOUT))
+
+    parser.add_option("--api-read-timeout", metavar="Seconds", type="int", default=DEFAULT_API_READ_TIMEOUT,
+                      help="Seconds to wait for AWS API responses (default={})".format(DEFAULT_API_READ_TIMEOUT))
+
+    parser.add_option("--socket", default=DEFAULT_SOCKET,
+                      help="Unix socket the serve daemon listens on (default={})".format(DEFAULT_SOCKET))
+
+    (opts, args) = parser.parse_args(argv)
 
     if len(args) < 1:
         parser.print_help()
         error()
 
     (action) = args[0]
+    opts.arguments = args[1:]  # command of exec, source and destination of push, given after --
 
     return opts, action
 
 
-def describe_all_instances(ec2):
-    return ec2.describe_instances()
+def iter_instances(ec2, **kwargs):
+    """Yields instances page by page, following NextToken until the last page"""
+    if "InstanceIds" not in kwargs:
+        kwargs["MaxResults"] = DESCRIBE_INSTANCES_PAGE_SIZE  # can't be combined with instance ids
+
+    while True:
+        resp = ec2.describe_instances(**kwargs)
+
+        for res in resp["Reservations"]:
+            for instance in res["Instances"]:
+                yield instance
+
+        token = resp.get("NextToken")
+        if not token:
+            break
+        kwargs["NextToken"] = token
+
+
+def describe_all_instances(ec2, filters=None):
+    if filters:
+        return iter_instances(ec2, Filters=filters)
+    return iter_instances(ec2)
 
 
 def describe_instances(ec2, instance_ids: list):
-    return ec2.describe_instances(InstanceIds=instance_ids)
+    return iter_instances(ec2, InstanceIds=instance_ids)
+
+
+def describe_instances_in_regions(clients, profile, regions, workers=DEFAULT_PARALLELISM, filters=None):
+    """Describes instances of all regions concurrently, yields (region, instance) sorted by region.
+
+    Instances of the region being printed are yielded as soon as their page arrives while the following
+    regions are fetched in the background, up to REGION_BUFFER_SIZE instances each. A region failing, i.e.
+    denied by an organization policy, is reported on stderr and skipped.
+    """
+    end = object()
+    stopped = threading.Event()  # set when the caller stops iterating, so fetches blocked on a full buffer end
+
+    def put(buffer, item):
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch(client, buffer):
+        try:
+            for instance in describe_all_instances(client, filters):
+                if not put(buffer, instance):
+                    return
+        except Exception as e:
+            put(buffer, e)
+        put(buffer, end)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        try:
+            buffers = []
+            for region in sorted(regions):
+                buffer = queue.Queue(maxsize=REGION_BUFFER_SIZE)
+                pool.submit(fetch, clients.client("ec2", profile, region), buffer)
+                buffers.append((region, buffer))
+
+            for region, buffer in buffers:
+                for instance in iter(buffer.get, end):
+                    if isinstance(instance, Exception):
+                        print("{}: {}".format(region, instance), file=sys.stderr)
+                        continue
+                    yield region, instance
+        finally:
+            stopped.set()
+
+
+def instance_filters(opts):
+    """describe_instances Filters of the --state, --tag, --instance-type and --zone options"""
+    filters = []
+
+    if opts.states:
+        filters.append({"Name": "instance-state-name", "Values": opts.states})
+
+    if opts.instance_type:
+        filters.append({"Name": "instance-type", "Values": [opts.instance_type]})
+
+    if opts.zone:
+        filters.append({"Name": "availability-zone", "Values": [opts.zone]})
+
+    tag_values = OrderedDict()
+    for tag in opts.tags or []:
+        key, has_value, value = tag.partition("=")
+        if not key:
+            raise ValueError("--tag must be Key=Value or Key, not '{}'".format(tag))
+        if has_value:
+            tag_values.setdefault(key, []).append(value)
+        else:
+            filters.append({"Name": "tag-key", "Values": [key]})
+
+    for key, values in tag_values.items():
+        filters.append({"Name": "tag:{}".format(key), "Values": values})
+
+    return filters
+
 
+def list_instances(ec2, clients, cache, opts):
+    filters = instance_filters(opts)
 
-def list_instances(ec2):
-    for res in describe_all_instances(ec2)["Reservations"]:
-        for instance in res["Instances"]:
-            prettify_instance(instance)
+    if opts.all_regions:
+        instances = describe_instances_in_regions(clients, profile_names(opts)[0], get_region_names(ec2, cache, opts),
+                                                  opts.parallel, filters)
+    else:
+        instances = ((ec2.meta.region_name, instance) for instance in describe_all_instances(ec2, filters))
+
+    if opts.query:
+        # project the given fields of the describe_instances response
+        fields = OrderedDict((path, lambda item, path=path: lookup(item[1], path)) for path in opts.query)
+        render(instances, fields, opts.output, None, lambda item: print_values(get(item) for get in fields.values()))
+    else:
+        render(instances, INSTANCE_FIELDS, opts.output, opts.columns, lambda item: prettify_instance(item[1]))
 
 
 def prettify_instance(instance):
@@ -210,17 +477,27 @@ def prettify_instance(instance):
                   instance["SecurityGroups"]))
 
 
-def list_regions(ec2):
-    for region in [region['RegionName'] for region in ec2.describe_regions()["Regions"]]:
-        print(region)
+def cache_key(ec2, opts, resource, query=None):
+    return [opts.profile if opts.profile else "default", ec2.meta.region_name, resource, query]
+
+
+def get_region_names(ec2, cache, opts):
+    return cache.get_or_load(cache_key(ec2, opts, "regions"), REGIONS_CACHE_TTL,
+                             lambda: [region['RegionName'] for region in ec2.describe_regions()["Regions"]])
+
+
+def list_regions(ec2, cache, opts):
+    render(get_region_names(ec2, cache, opts), REGION_FIELDS, opts.output, opts.columns)
 
 
-def list_availability_zones(ec2, opts):
-    for zone in [zone["ZoneName"] for zone in ec2.describe_availability_zones()["AvailabilityZones"]]:
-        print(zone)
+def list_availability_zones(ec2, cache, opts):
+    zones = cache.get_or_load(cache_key(ec2, opts, "zones"), ZONES_CACHE_TTL,
+                              lambda: [zone["ZoneName"] for zone in
+                                       ec2.describe_availability_zones()["AvailabilityZones"]])
+    render(zones, ZONE_FIELDS, opts.output, opts.columns)
 
 
-def list_images(ec2):
+def list_images(ec2, cache, opts):
     # for now listS only ubuntu images
     filters = [
         {
@@ -249,18 +526,10 @@ def list_images(ec2):
             'Values': ['true']
         }]
 
-    for image_info in [(image["Name"], image["ImageId"]) for image in ec2.describe_images(Filters=filters)["Images"]]:
-        print(image_info)
-
-
-def wait_for_instances(ec2, opts, instances, expected_state="instance_running"):
-    print("waiting for instances to reach '{}' state...".format(expected_state))
-
-    waiter = ec2.get_waiter(expected_state)
-    waiter.wait(
-        InstanceIds=[i["InstanceId"] for i in instances],
-        DryRun=bool(opts.dry_run)
-    )
+    images = cache.get_or_load(cache_key(ec2, opts, "images", filters), IMAGES_CACHE_TTL,
+                               lambda: [(image["Name"], image["ImageId"]) for image in
+                                        ec2.describe_images(Filters=filters)["Images"]])
+    render(images, IMAGE_FIELDS, opts.output, opts.columns, lambda image_info: print(tuple(image_info)))
 
 
 def create_instances(ec2, opts):
@@ -284,7 +553,7 @@ def create_instances(ec2, opts):
     resp = ec2.run_instances(
         ImageId=opts.ami,
         KeyName=key,
-        InstanceType=opts.instance_type,
+        InstanceType=opts.instance_type if opts.instance_type else DEFAULT_INSTANCE_TYPE,
         MinCount=opts.count,
         MaxCount=opts.count,
         SecurityGroups=[sec_group],
@@ -292,7 +561,8 @@ def create_instances(ec2, opts):
             "AvailabilityZone": opts.zone
         },
         BlockDeviceMappings=create_new_block_device_mapping(opts),
-        DryRun=bool(opts.dry_run)
+        DryRun=bool(opts.dry_run),
+        **name_tag_specifications(opts)
     )
 
     for instance in resp["Instances"]:
@@ -303,36 +573,55 @@ def create_instances(ec2, opts):
 
     instances = resp["Instances"]
 
-    # tags
-    if opts.name_tag:
-        print("giving name tags...")
-        time.sleep(5)
-        i = 0
-        for instance in instances:
-            ec2.create_tags(
-                Resources=[instance["InstanceId"]],
-                Tags=[{"Key": "Name",
-                       "Value": "{n}{id}".format(n=opts.name_tag, id="" if len(instances) == 1 else "-{}".format(i))}])
-            i += 1
-
-    # wait for instances
-    if opts.wait or opts.install_docker:
-        wait_for_instances(ec2, opts, instances)
+    from eyws.docker import install_docker_on
+    from eyws.fleet import Fleet
+    from eyws.waiter import visible_states
+
+    # every instance is tagged, waited for and provisioned on its own
+    fleet = Fleet(instances,
+                  lambda instance_ids: visible_states(ec2, instance_ids),
+                  lambda instance_ids: describe_instances(ec2, instance_ids),
+                  tag=(lambda index, instance: tag_instance_name(ec2, opts, index, instance))
+                  if opts.name_tag and len(instances) > 1 else None,
+                  provision=(lambda instance: install_docker_on(opts, instance)) if opts.install_docker else None,
+                  wait=opts.wait,
+                  workers=opts.parallel,
+                  interval=opts.wait_interval,
+                  ssh_max_wait=opts.ssh_max_wait)
+
+    print("bringing instances up to {}...".format(fleet.target))
+    succeeded, failed = fleet.run()
 
     # instance information
-    instances = describe_instances(ec2, [k["InstanceId"] for k in instances])["Reservations"]
-    for res in instances:
-        for instance in res["Instances"]:
-            prettify_instance(instance)
+    for instance in describe_instances(ec2, [k["InstanceId"] for k in instances]):
+        prettify_instance(instance)
 
-    # docker
-    if opts.install_docker:
-        print("installing docker...")
-        install_docker(opts, instances)
+    fleet.print_report()
+
+    if failed:
+        raise Exception("{} of {} instances failed".format(len(failed), len(instances)))
 
     print("instances created.")
 
 
+def name_tag_specifications(opts):
+    """run_instances arguments tagging every instance with the --name tag as it launches"""
+    if not opts.name_tag:
+        return {}
+    return {"TagSpecifications": [{"ResourceType": "instance", "Tags": [{"Key": "Name", "Value": opts.name_tag}]}]}
+
+
+def tag_instance_name(ec2, opts, index, instance):
+    """Renames an instance launched together with others to <name>-<index>.
+
+    create_tags gives all its resources the same tags, so every distinct name takes a call of its own; they are
+    made concurrently by the fleet, retrying while a new instance isn't visible to the tagging API yet.
+    """
+    call_with_backoff(ec2.create_tags, ["InvalidInstanceID.NotFound"],
+                      Resources=[instance["InstanceId"]],
+                      Tags=[{"Key": "Name", "Value": "{n}-{i}".format(n=opts.name_tag, i=index)}])
+
+
 def provision_docker(ec2, opts):
     if opts.instance_ids is None:
         error("List of instances must be specified with --instance-ids flag!")
@@ -343,7 +632,9 @@ def provision_docker(ec2, opts):
     if opts.user is None:
         error("SSH user (-u or --user) is missing!")
 
-    install_docker(opts, describe_instances(ec2, opts.instance_ids)["Reservations"])
+    from eyws.docker import install_docker
+
+    install_docker(opts, list(describe_instances(ec2, opts.instance_ids)))
 
 
 def create_new_block_device_mapping(opts):
@@ -364,23 +655,30 @@ def create_new_block_device_mapping(opts):
     return block_device_mappings
 
 
-def list_security_groups(ec2):
-    for sec_group in ec2.describe_security_groups()["SecurityGroups"]:
-        print("name={}\ngroupId={}\ndescription={}\nIpPermissions={}\n"
-              .format(sec_group["GroupName"],
-                      sec_group["GroupId"],
-                      sec_group["Description"],
-                      [("port={}".format(ip_permission["FromPort"]),
-                        "cidr={}".format(ip_permission["IpRanges"][0]["CidrIp"])) for ip_permission in
-                       sec_group["IpPermissions"]]))
+def list_security_groups(ec2, opts):
+    render(ec2.describe_security_groups()["SecurityGroups"], SECURITY_GROUP_FIELDS, opts.output, opts.columns,
+           prettify_security_group)
+
+
+def prettify_security_group(sec_group):
+    print("name={}\ngroupId={}\ndescription={}\nIpPermissions={}\n"
+          .format(sec_group["GroupName"],
+                  sec_group["GroupId"],
+                  sec_group["Description"],
+                  [("port={}".format(ip_permission["FromPort"]),
+                    "cidr={}".format(ip_permission["IpRanges"][0]["CidrIp"])) for ip_permission in
+                   sec_group["IpPermissions"]]))
 
 
-def list_key_pairs(ec2):
-    for key_pair in [key_pair["KeyName"] for key_pair in ec2.describe_key_pairs()["KeyPairs"]]:
-        print(key_pair)
+def list_key_pairs(ec2, cache, opts):
+    key_pairs = cache.get_or_load(cache_key(ec2, opts, "key-pairs"), KEY_PAIRS_CACHE_TTL,
+                                  lambda: [key_pair["KeyName"] for key_pair in ec2.describe_key_pairs()["KeyPairs"]])
+    render(key_pairs, KEY_PAIR_FIELDS, opts.output, opts.columns)
 
 
 def get_or_create_key_pair(ec2, opts):
+    from botocore.exceptions import ClientError
+
     try:
         return ec2.describe_key_pairs(KeyNames=[opts.key_pair])["KeyPairs"][0]["KeyName"]
     except ClientError as e:
@@ -395,6 +693,8 @@ def get_or_create_key_pair(ec2, opts):
 
 
 def get_or_create_security_group(ec2, opts):
+    from botocore.exceptions import ClientError
+
     try:
         return ec2.describe_security_groups(GroupNames=[opts.sec_group])["SecurityGroups"][0]["GroupName"]
     except ClientError as e:
@@ -419,57 +719,243 @@ def get_or_create_security_group(ec2, opts):
             raise
 
 
-def stop_instances(ec2, opts):
-    if opts.instance_ids is None:
-        error("Please set --instance-id to stop instances!")
+def stop_instances(ec2, clients, cache, opts):
+    change_instance_states(ec2, clients, cache, opts, "stop")
 
-    resp = input("Following instances will be stopped {}\n\nAre you sure you want to stop instances? (y/N):".
-                 format(opts.instance_ids))
 
-    if resp == 'y':
-        print("Stopping following instances {}...".format(opts.instance_ids))
-        resp = ec2.stop_instances(InstanceIds=opts.instance_ids, DryRun=bool(opts.dry_run))
+def terminate_instances(ec2, clients, cache, opts):
+    change_instance_states(ec2, clients, cache, opts, "terminate")
 
-        for instance_info in [(state["InstanceId"], state["PreviousState"]["Name"], state["CurrentState"]["Name"])
-                              for state in resp["StoppingInstances"]]:
-            print("\ninstanceId={}\npreviousState={}\ncurrentState={}".format(instance_info[0],
-                                                                              instance_info[1],
-                                                                              instance_info[2]))
 
+def start_instances(ec2, clients, cache, opts):
+    change_instance_states(ec2, clients, cache, opts, "start")
 
-def terminate_instances(ec2, opts):
-    if opts.instance_ids is None:
-        error("Please set --instance-id to terminate instances!")
 
-    resp = input("Following instances will be terminated {}\n\nAre you sure you want to terminate instances? (y/N):".
-                 format(opts.instance_ids))
+def filtered_instances(ec2, clients, cache, opts, verb, states):
+    """(region, instance) of the instances matching the filters, in every region with --all-regions.
 
-    if resp == 'y':
-        print("Terminating following instances {}...".format(opts.instance_ids))
-        resp = ec2.terminate_instances(InstanceIds=opts.instance_ids, DryRun=bool(opts.dry_run))
+    Without --state only instances in the given states match.
+    """
+    filters = instance_filters(opts)
+    if not filters:
+        error("Please set --instance-id or filters (--tag, --state, --instance-type, --zone) to {} instances!"
+              .format(verb))
 
-        for instance_info in [(state["InstanceId"], state["PreviousState"]["Name"], state["CurrentState"]["Name"])
-                              for state in resp["TerminatingInstances"]]:
-            print("\ninstanceId={}\npreviousState={}\ncurrentState={}".format(instance_info[0],
-                                                                              instance_info[1],
-                                                                              instance_info[2]))
+    if not opts.states:
+        filters.append({"Name": "instance-state-name", "Values": states})
 
+    if opts.all_regions:
+        return describe_instances_in_regions(clients, profile_names(opts)[0], get_region_names(ec2, cache, opts),
+                                             opts.parallel, filters)
+    return ((ec2.meta.region_name, instance) for instance in describe_all_instances(ec2, filters))
 
-def start_instances(ec2, opts):
-    if opts.instance_ids is None:
-        error("Please set --instance-id to start instances!")
 
-    print("Starting following instances {}...".format(opts.instance_ids))
-    resp = ec2.start_instances(InstanceIds=opts.instance_ids, DryRun=bool(opts.dry_run))
+def matching_instances(ec2, opts, filters, verb):
+    """Instances of --instance-id matching filters, the ids that don't match are reported on stderr"""
+    instances = list(iter_instances(ec2, InstanceIds=opts.instance_ids, Filters=filters))
+    matching = {instance["InstanceId"] for instance in instances}
+    for instance_id in opts.instance_ids:
+        if instance_id not in matching:
+            print("{} doesn't match the filters, not going to {} it".format(instance_id, verb), file=sys.stderr)
+    return instances
+
+
+def target_instances(ec2, clients, cache, opts, change):
+    """{region: [instance id]} of --instance-id, or of the instances matching the filters in every --all-regions.
+
+    --instance-id together with filters targets only the given instances matching the filters.
+    """
+    if opts.instance_ids:
+        filters = instance_filters(opts)
+        if not filters:
+            return OrderedDict([(ec2.meta.region_name, opts.instance_ids)])
+
+        instance_ids = [instance["InstanceId"] for instance in matching_instances(ec2, opts, filters, change)]
+        return OrderedDict([(ec2.meta.region_name, instance_ids)] if instance_ids else [])
+
+    targets = OrderedDict()
+    # only instances the change applies to unless --state is given
+    for region, instance in filtered_instances(ec2, clients, cache, opts, change, STATE_CHANGES[change][2]):
+        targets.setdefault(region, []).append(instance["InstanceId"])
+    return targets
+
+
+def change_instance_states(ec2, clients, cache, opts, change):
+    """Stops, starts or terminates the target instances in chunks, concurrently across chunks and regions"""
+    method, response_key, _, waiter_name = STATE_CHANGES[change]
+    targets = target_instances(ec2, clients, cache, opts, change)
+    total = sum(len(instance_ids) for instance_ids in targets.values())
+
+    if not total:
+        print("No instances to {}.".format(change))
+        return
+
+    if change != "start" and not opts.yes:
+        if not sys.stdin.isatty():
+            raise Exception("Can't ask for confirmation without a terminal, use --yes to {} instances".format(change))
+        resp = input("Following instances will be {}\n\n{}\n\nAre you sure you want to {} instances? (y/N):"
+                     .format(STATE_CHANGE_PARTICIPLES[change][1],
+                             "\n".join("{} {}".format(region, ids) for region, ids in targets.items()),
+                             change))
+        if resp != 'y':
+            return
+
+    print("{} {} instances...".format(STATE_CHANGE_PARTICIPLES[change][0], total))
+
+    def change_chunk(task):
+        region, instance_ids = task
+        client = clients.client("ec2", profile_names(opts)[0], region)
+        return getattr(client, method)(InstanceIds=instance_ids, DryRun=bool(opts.dry_run))[response_key]
+
+    tasks = [(region, instance_ids[i:i + STATE_CHANGE_CHUNK_SIZE])
+             for region, instance_ids in targets.items()
+             for i in range(0, len(instance_ids), STATE_CHANGE_CHUNK_SIZE)]
+
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max(1, min(opts.parallel, len(tasks)))) as pool:
+        futures = [(task, pool.submit(change_chunk, task)) for task in tasks]
+        for (region, instance_ids), future in futures:
+            try:
+                changes = future.result()
+            except Exception as e:
+                print("failed to {} {} instances in {}: {}".format(change, len(instance_ids), region, e),
+                      file=sys.stderr)
+                failed.update(instance_ids)
+                continue
+
+            for state in changes:
+                print("\ninstanceId={}\npreviousState={}\ncurrentState={}".format(state["InstanceId"],
+                                                                                  state["PreviousState"]["Name"],
+                                                                                  state["CurrentState"]["Name"]))
+
+    if opts.wait_state:
+        for region, instance_ids in targets.items():
+            changed = [instance_id for instance_id in instance_ids if instance_id not in failed]
+            if changed:
+                wait_for_state(clients.client("ec2", profile_names(opts)[0], region), opts, changed, waiter_name)
+
+    if failed:
+        raise Exception("failed to {} {} of {} instances".format(change, len(failed), total))
+
+
+def wait_for_state(ec2, opts, instance_ids, waiter_name):
+    """Prints each instance as it reaches the state of waiter_name, fails if any of them didn't"""
+    from eyws.fanout import host_print
+    from eyws.waiter import WAITERS, as_reached
+
+    target = WAITERS[waiter_name][0]
+    print("waiting for instances to be {}...".format(target))
+
+    failed = []
+    for instance_id, state in as_reached(ec2, instance_ids, waiter_name, opts.wait_interval, workers=opts.parallel):
+        host_print(instance_id, state)
+        if state != target:
+            failed.append(instance_id)
+
+    if failed:
+        raise Exception("{} of {} instances are not {}: {}".format(len(failed), len(instance_ids), target, failed))
+
+
+def ssh_instances(ec2, clients, cache, opts, verb):
+    """(running, skipped) instances of --instance-id, or the running instances matching the filters.
+
+    Fails when none of them is running but some were skipped.
+    """
+    if opts.identity is None:
+        error("Identity flag (-i or --identity) must be set in order ssh instances!")
+
+    if opts.user is None:
+        error("SSH user (-u or --user) is missing!")
+
+    from eyws.fanout import host_print
+
+    if opts.instance_ids:
+        filters = instance_filters(opts)
+        instances = matching_instances(ec2, opts, filters, verb) if filters \
+            else list(describe_instances(ec2, opts.instance_ids))
+    else:
+        instances = [instance for _, instance in filtered_instances(ec2, clients, cache, opts, verb, ["running"])]
+
+    skipped = [instance for instance in instances if instance["State"]["Name"] != "running"]
+    for instance in skipped:
+        host_print(instance["InstanceId"], "skipped, instance is {}".format(instance["State"]["Name"]),
+                   file=sys.stderr)
+
+    running = [instance for instance in instances if instance["State"]["Name"] == "running"]
+    if not running:
+        print("No running instances to {}.".format(verb))
+        if skipped:
+            raise Exception("{} instances are not running".format(len(skipped)))
+
+    return running, skipped
+
+
+def exec_command(ec2, clients, cache, opts):
+    """Runs the command given after -- on every --instance-id or running instance matching the filters"""
+    if not opts.arguments:
+        error("Command to run must be given after --, i.e. eyws exec --tag env=prod -- uptime")
+
+    from eyws.remote import print_exit_codes, print_result, run_on_instances
+
+    instances, skipped = ssh_instances(ec2, clients, cache, opts, "run commands on")
+    if not instances:
+        return
+
+    # joined like ssh joins its arguments, so the remote shell sees pipes, && and $VARs of a quoted command
+    command = " ".join(opts.arguments)
+    results = []
+
+    def run():
+        for result in run_on_instances(opts, instances, command, opts.host_timeout, opts.parallel):
+            results.append(result)
+            yield result
+
+    render(run(), EXEC_FIELDS, opts.output, opts.columns, print_result)
+    if opts.output == "text":
+        print_exit_codes(results, [instance["InstanceId"] for instance in skipped])
+
+    failed = [result for result in results if not result.ok]
+    if failed or skipped:
+        raise Exception("command failed on {} of {} instances".format(len(failed) + len(skipped),
+                                                                     len(results) + len(skipped)))
+
+
+def push_files(ec2, clients, cache, opts):
+    """Copies the local source given after -- to its destination on every --instance-id or matching instance"""
+    if len(opts.arguments) != 2:
+        error("Source and destination must be given after --, i.e. eyws push --tag env=prod -- app.tar /tmp/")
+
+    source, destination = opts.arguments
+    if not os.path.exists(source):
+        error("{} doesn't exist!".format(source))
 
-    for instance_info in [(instance["InstanceId"], instance["PreviousState"]["Name"], instance["CurrentState"]["Name"])
-                          for instance in resp["StartingInstances"]]:
-        print("\ninstanceId={}\npreviousState={}\ncurrentState={}".format(instance_info[0],
-                                                                          instance_info[1],
-                                                                          instance_info[2]))
+    from eyws.fanout import print_summary
+    from eyws.push import Push
+
+    instances, skipped = ssh_instances(ec2, clients, cache, opts, "push files to")
+    if not instances:
+        return
+
+    print("copying {} to {} of {} instances{}...".format(source, destination, len(instances),
+                                                         ", relayed between instances" if opts.relay else ""))
+    started = time.monotonic()
+    succeeded, failed = Push(opts, instances, source, destination, opts.relay, opts.parallel, opts.host_timeout).run()
+    print_summary(succeeded, failed + [(instance["InstanceId"], "instance is {}".format(instance["State"]["Name"]))
+                                       for instance in skipped])
+    print("in {:.1f}s".format(time.monotonic() - started))
+
+    if failed or skipped:
+        raise Exception("failed to push files to {} of {} instances".format(len(failed) + len(skipped),
+                                                                           len(instances) + len(skipped)))
+
+
+def get_account_id(sts):
+    return sts.get_caller_identity()["Account"]
 
 
 def get_organization_info(client_org):
+    from botocore.exceptions import ClientError
+
     try:
         org_info = client_org.describe_organization()
     except ClientError as e:
@@ -479,17 +965,26 @@ def get_organization_info(client_org):
         return [org_info["Organization"]["Id"], org_info["Organization"]["MasterAccountEmail"]]
 
 
-def list_costs(ce, org, opts):
-    org_info = get_organization_info(org)
+def list_costs(clients, cache, opts):
+    if opts.output != "text":
+        rows = (row for report in get_cost_reports(clients, cache, opts)
+                for periodic_cost in report.costs for row in periodic_cost.rows())
+        render(rows, COST_FIELDS, opts.output, opts.columns)
+        return
 
-    if org_info is not None:
-        print("Organization Id = {}\nOrganization Master Account = {}".format(org_info[0], org_info[1]))
+    for report in get_cost_reports(clients, cache, opts):
+        for org_info in report.organizations:
+            print("Organization Id = {}\nOrganization Master Account = {}".format(org_info[0], org_info[1]))
 
-    for periodic_cost in get_costs(ce, opts):
-        periodic_cost.prettify()
+        for periodic_cost in report.costs:
+            periodic_cost.prettify()
 
 
 def send_email(host, port, sender, to, data, subject):
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     msg = MIMEMultipart('alternative')
 
     msg['Subject'] = subject
@@ -503,18 +998,14 @@ def send_email(host, port, sender, to, data, subject):
     s.quit()
 
 
-def email_costs(ce, org, opts):
+def email_costs(clients, cache, opts):
     if not opts.template or not os.path.isfile(opts.template):
         raise ValueError("--template value is required. Make sure to pass a valid existing file.")
 
     if not opts.emails or not opts.smtp_host or not opts.smtp_from:
         raise ValueError("--emails, --smtp-host and --smtp-from are required for sending email")
 
-    # get costs
-    costs = get_costs(ce, opts)
-
-    # organization info
-    org_info = get_organization_info(org)
+    from jinja2 import Environment, FileSystemLoader
 
     # render template
     template_dir = os.path.abspath(os.path.join(
@@ -524,19 +1015,129 @@ def email_costs(ce, org, opts):
 
     template = j2_env.get_template(os.path.basename(opts.template))
 
-    rendered_text = template.render(costs=costs, organization=org_info)
+    # one email per organization unless merged
+    for report in get_cost_reports(clients, cache, opts):
+        org_info = report.organizations[0] if len(report.organizations) == 1 else None
+
+        rendered_text = template.render(costs=report.costs, organization=org_info)
+
+        # send email
+        send_email(opts.smtp_host,
+                   opts.smtp_port,
+                   opts.smtp_from,
+                   opts.emails,
+                   rendered_text,
+                   DEFAULT_COST_EMAIL_SUBJECT if not org_info else "{} for {}".format(DEFAULT_COST_EMAIL_SUBJECT,
+                                                                                      org_info[1]))
+
+
+def call_with_backoff(call, retry_codes, **kwargs):
+    """Calls an AWS API, retrying with exponential backoff and jitter while it fails with one of retry_codes.
+
+    Throttling is retried by the clients themselves (see eyws.clients), retry_codes are for errors like
+    InvalidInstanceID.NotFound that only go away after a while.
+    """
+    from botocore.exceptions import ClientError
 
-    # send email
-    send_email(opts.smtp_host,
-               opts.smtp_port,
-               opts.smtp_from,
-               opts.emails,
-               rendered_text,
-               DEFAULT_COST_EMAIL_SUBJECT if not org_info else "{} for {}".format(DEFAULT_COST_EMAIL_SUBJECT,
-                                                                                  org_info[1]))
+    attempt = 0
+    while True:
+        try:
+            return call(**kwargs)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in retry_codes or attempt >= MAX_API_RETRIES:
+                raise
+            time.sleep(random.uniform(0, min(MAX_API_RETRY_DELAY, 2 ** attempt)))
+            attempt += 1
+
+
+def fetch_cost_periods(ce, start, end, group_by, granularity="MONTHLY"):
+    periods = OrderedDict()
+    token = None
+    while True:
+        if token:
+            kwargs = {'NextPageToken': token}
+        else:
+            kwargs = {}
+
+        resp = ce.get_cost_and_usage(
+            TimePeriod={
+                "Start": start,
+                "End": end
+            },
+            Granularity=granularity,
+            Metrics=[DEFAULT_COST_METRICS_TYPE],
+            GroupBy=group_by,
+            **kwargs)
+
+        # groups of a period may be split across pages
+        for period in resp['ResultsByTime']:
+            if period["TimePeriod"]["Start"] in periods:
+                periods[period["TimePeriod"]["Start"]]["Groups"] += period["Groups"]
+            else:
+                periods[period["TimePeriod"]["Start"]] = period
+
+        token = resp.get('NextPageToken')
+        if not token:
+            break
+
+    return list(periods.values())
+
+
+def month_shards(start, end):
+    """Splits the period from start to end (exclusive) at month boundaries"""
+    from dateutil.relativedelta import relativedelta
+
+    shards = []
+    shard_start = start
+    while shard_start < end:
+        shard_end = min((datetime.strptime(shard_start, "%Y-%m-%d") + relativedelta(months=1, day=1))
+                        .strftime("%Y-%m-%d"), end)
+        shards.append((shard_start, shard_end))
+        shard_start = shard_end
+    return shards
 
 
-def get_costs(ce, opts):
+def fetch_cost_shards(ce, shards, group_by, workers=DEFAULT_PARALLELISM, granularity="MONTHLY"):
+    """Fetches every (start, end) shard concurrently, periods are returned in shard order"""
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(shards)))) as pool:
+        results = pool.map(lambda shard: fetch_cost_periods(ce, shard[0], shard[1], group_by, granularity), shards)
+        return [period for periods in results for period in periods]
+
+
+def is_closed_cost_period(period_end):
+    """Costs of a period no longer change once it ended and the month's bill has been finalized"""
+    from dateutil.relativedelta import relativedelta
+
+    return datetime.strptime(period_end, "%Y-%m-%d") + relativedelta(days=COST_FINALIZATION_DAYS) <= datetime.now()
+
+
+def get_monthly_cost_periods(ce, cache, account_id, start, end, group_by, workers=DEFAULT_PARALLELISM):
+    """Monthly costs between start and end; closed months are served from the cache, the rest is fetched"""
+
+    def key(month_start):
+        return ["costs", account_id, month_start, DEFAULT_COST_METRICS_TYPE, [g["Key"] for g in group_by]]
+
+    periods = []
+    missing = []
+
+    for month_start, month_end in month_shards(start, end):
+        cached = cache.get(key(month_start)) if is_closed_cost_period(month_end) else None
+        if cached is not None:
+            periods.append(cached)
+        else:
+            missing.append((month_start, month_end))
+
+    for period in fetch_cost_shards(ce, missing, group_by, workers):
+        periods.append(period)
+        if is_closed_cost_period(period["TimePeriod"]["End"]):
+            cache.set(key(period["TimePeriod"]["Start"]), period)
+
+    return periods
+
+
+def cost_period(opts):
+    from dateutil.relativedelta import relativedelta
+
     if opts.days:
         start = datetime.now() - relativedelta(days=opts.days)  # show usage costs starting from X days ago
     else:
@@ -551,41 +1152,83 @@ def get_costs(ce, opts):
     start = start.strftime("%Y-%m-%d")
     end = datetime.now().strftime("%Y-%m-%d")  # end time is always now i.e. date range selection not supported
 
-    account_map = get_account_names(ce, start, end)
+    return start, end
+
 
+def cost_group_by(ignore_service_usage):
     # ignore service details if --ignore-service-usage is set
     group_by = [{"Type": "DIMENSION", "Key": "LINKED_ACCOUNT"}]
 
-    if not opts.ignore_service_usage:
+    if not ignore_service_usage:
         group_by.append(
             {
                 "Type": "DIMENSION",
                 "Key": "SERVICE"
             })
 
-    periods = []
-    token = None
-    while True:
-        if token:
-            kwargs = {'NextPageToken': token}
-        else:
-            kwargs = {}
+    return group_by
 
-        resp = ce.get_cost_and_usage(
-            TimePeriod={
-                "Start": start,
-                "End": end
-            },
-            Granularity="MONTHLY",
-            Metrics=[DEFAULT_COST_METRICS_TYPE],
-            GroupBy=group_by,
-            **kwargs)
 
-        periods += resp['ResultsByTime']
-        token = resp.get('NextPageToken')
-        if not token:
-            break
+def sync_costs(ce, store, account_id, opts):
+    start, end = cost_period(opts)
+
+    for start, end in store.sync_ranges(account_id, start, end):
+        print("syncing daily costs from {} to {}...".format(start, end))
+        periods = fetch_cost_shards(ce, month_shards(start, end), cost_group_by(False), opts.parallel,
+                                    granularity="DAILY")
+        store.replace_days(account_id, start, end, periods)
+        print("{} days synced.".format(len(periods)))
+
+
+def get_cost_periods(ce, org, cache, account_id, opts):
+    """Cost Explorer shaped periods of the payer account_id, newest first, and its account directory"""
+    from eyws.accounts import AccountDirectory
+    from eyws.coststore import CostStore
+
+    start, end = cost_period(opts)
+
+    if opts.local:
+        store = CostStore()
+        try:
+            periods = store.periods(account_id, start, end, opts.rollup, not opts.ignore_service_usage)
+            synced = store.synced_range(account_id)
+        finally:
+            store.close()
+
+        if synced is None or not periods:
+            print("No local costs from {} to {} of account {}, run sync-costs for them first"
+                  .format(start, end, account_id), file=sys.stderr)
+        elif start < synced[0]:
+            print("Local costs of account {} start on {}, run sync-costs for the ones since {}"
+                  .format(account_id, synced[0], start), file=sys.stderr)
+    elif opts.days:
+        periods = fetch_cost_shards(ce, month_shards(start, end), cost_group_by(opts.ignore_service_usage),
+                                    opts.parallel)
+    else:
+        periods = get_monthly_cost_periods(ce, cache, account_id, start, end,
+                                           cost_group_by(opts.ignore_service_usage), opts.parallel)
 
+    sort_cost_periods(periods)
+
+    account_map = AccountDirectory.load(ce, org, cache, account_id, start, end,
+                                        {group["Keys"][0] for period in periods for group in period["Groups"]})
+
+    return periods, account_map
+
+
+def merge_cost_periods(periods):
+    """Periods starting on the same day combined into one having the groups of all of them, the input is kept"""
+    merged = OrderedDict()
+    for period in periods:
+        start = period["TimePeriod"]["Start"]
+        if start in merged:
+            merged[start]["Groups"] += period["Groups"]
+        else:
+            merged[start] = dict(period, Groups=list(period["Groups"]))
+    return list(merged.values())
+
+
+def sort_cost_periods(periods):
     # desc sort by start time
     try:
         periods.sort(key=lambda json: json["TimePeriod"]["Start"], reverse=True)
@@ -593,88 +1236,145 @@ def get_costs(ce, opts):
         # do not sort then
         pass
 
+
+def build_costs(periods, account_map, opts):
+    from eyws.costs import periodic_costs
+
+    monthly = opts.rollup == "month" if opts.local else not opts.days
+
+    def label(period):
+        return datetime.strptime(period["TimePeriod"]["Start"], "%Y-%m-%d").strftime("%B %Y") \
+            if monthly else period["TimePeriod"]["Start"]
+
     # prepare cost data
-    costs_by_periods = []  # type: List[PeriodicCosts]
+    return periodic_costs(periods, account_map, not opts.ignore_service_usage, label)
 
-    for period in periods:
 
-        month = datetime.strptime(period["TimePeriod"]["Start"], "%Y-%m-%d").strftime("%B %Y") \
-            if not opts.days else period["TimePeriod"]["Start"]
+def get_costs(ce, org, cache, account_id, opts):
+    return build_costs(*get_cost_periods(ce, org, cache, account_id, opts), opts)
 
-        periodic_cost_info = PeriodicCosts(month)
 
-        for service_usage in period["Groups"]:
+CostReport = namedtuple("CostReport", ["organizations", "costs"])
 
-            value = Decimal(service_usage["Metrics"]["BlendedCost"]["Amount"])
 
-            if value != 0:
-                account = account_map[service_usage["Keys"][0]]
-                service = service_usage["Keys"][1] if not opts.ignore_service_usage else None
-                unit = service_usage["Metrics"]["BlendedCost"]["Unit"]
+def profile_names(opts):
+    return opts.profile.split(",") if opts.profile else [None]
 
-                periodic_cost_info.add_cost(ServiceUsageCost(account,
-                                                             service,
-                                                             value.quantize(Decimal(".01"), rounding=ROUND_HALF_UP),
-                                                             unit))
-        # sort usage costs by account
-        periodic_cost_info.account_service_usage = sorted(periodic_cost_info.account_service_usage.items())
-        costs_by_periods.append(periodic_cost_info)
 
-    return costs_by_periods
+def get_profile_cost_periods(clients, profile, cache, opts):
+    """(organization info, periods, account directory) of the payer account of profile"""
+    ce = clients.client("ce", profile)
+    org = clients.client("organizations", profile)
 
+    periods, account_map = get_cost_periods(ce, org, cache, get_account_id(clients.client("sts", profile)), opts)
 
-def get_account_names(ce, start, end):
-    resp = ce.get_dimension_values(
-        TimePeriod={
-            "Start": start,
-            "End": end
-        },
-        Dimension="LINKED_ACCOUNT"
-    )
+    return get_organization_info(org), periods, account_map
+
+
+def get_cost_reports(clients, cache, opts):
+    """Cost reports of every --profile fetched concurrently, one per profile or a single one with --merge"""
+    from eyws.accounts import AccountDirectory
+
+    profiles = profile_names(opts)
+
+    with ThreadPoolExecutor(max_workers=len(profiles)) as pool:
+        results = list(pool.map(lambda profile: get_profile_cost_periods(clients, profile, cache, opts), profiles))
+
+    if not opts.merge:
+        return [CostReport([org_info] if org_info else [], build_costs(periods, account_map, opts))
+                for org_info, periods, account_map in results]
 
-    account_map = {}
-    for account_info in resp["DimensionValues"]:
-        account_map[account_info["Value"]] = account_info["Attributes"]["description"]
+    periods = merge_cost_periods(period for _, profile_periods, _ in results for period in profile_periods)
+    sort_cost_periods(periods)
 
-    return account_map
+    names = {}
+    for _, _, account_map in results:
+        names.update(account_map.names)
 
+    return [CostReport([org_info for org_info, _, _ in results if org_info],
+                       build_costs(periods, AccountDirectory(names), opts))]
 
-def execute():
-    (opts, action) = parse_args()
+
+def execute(argv=None, factories=None):
+    """Runs the action of argv (default=sys.argv[1:]).
+
+    factories keeps the client factories across calls so that a serve daemon reuses warm clients.
+    """
+    (opts, action) = parse_args(argv)
 
     try:
 
-        session = boto3.Session(profile_name=opts.profile if opts.profile else None,
-                                region_name=opts.region if opts.region else None)
+        if len(profile_names(opts)) > 1 and action not in ["list-costs", "email-costs"]:
+            raise ValueError("Multiple profiles are only supported by list-costs and email-costs")
+
+        if opts.all_regions and opts.instance_ids:
+            raise ValueError("--all-regions can't be combined with --instance-id, instance ids are looked up in "
+                             "--region only")
+
+        if action == "serve" and factories is not None:
+            raise ValueError("Already serving")
+
+        if opts.columns and action in ACTION_FIELDS:
+            select_fields(ACTION_FIELDS[action], opts.columns)  # fails on unknown columns before fetching anything
+
+        profile = profile_names(opts)[0]
+
+        if factories is None:
+            factories = {}
 
-        ec2 = session.client("ec2")
+        # clients are created only for the actions that need them
+        client_options = (opts.region if opts.region else None, opts.parallel, opts.api_connect_timeout,
+                          opts.api_read_timeout)
+        if client_options not in factories:
+            factories[client_options] = ClientFactory(*client_options)
+        clients = factories[client_options]
+
+        ec2 = clients.client("ec2", profile) if action in EC2_ACTIONS else None
+
+        cache = Cache(refresh=opts.refresh)
 
         if action == "create-instances":
             create_instances(ec2, opts)
         elif action == "list-sec-groups":
-            list_security_groups(ec2)
+            list_security_groups(ec2, opts)
         elif action == "list-instances":
-            list_instances(ec2)
+            list_instances(ec2, clients, cache, opts)
         elif action == "list-regions":
-            list_regions(ec2)
+            list_regions(ec2, cache, opts)
         elif action == "list-zones":
-            list_availability_zones(ec2, opts)
+            list_availability_zones(ec2, cache, opts)
         elif action == "list-images":
-            list_images(ec2)
+            list_images(ec2, cache, opts)
         elif action == "list-key-pairs":
-            list_key_pairs(ec2)
+            list_key_pairs(ec2, cache, opts)
         elif action == "stop-instances":
-            stop_instances(ec2, opts)
+            stop_instances(ec2, clients, cache, opts)
         elif action == "start-instances":
-            start_instances(ec2, opts)
+            start_instances(ec2, clients, cache, opts)
         elif action == "terminate-instances":
-            terminate_instances(ec2, opts)
+            terminate_instances(ec2, clients, cache, opts)
         elif action == "list-costs":
-            list_costs(session.client("ce"), session.client("organizations"), opts)
+            list_costs(clients, cache, opts)
         elif action == "email-costs":
-            email_costs(session.client("ce"), session.client("organizations"), opts)
+            email_costs(clients, cache, opts)
+        elif action == "sync-costs":
+            from eyws.coststore import CostStore
+
+            store = CostStore()
+            try:
+                sync_costs(clients.client("ce", profile), store, get_account_id(clients.client("sts", profile)), opts)
+            finally:
+                store.close()
         elif action == "install-docker":
             provision_docker(ec2, opts)
+        elif action == "exec":
+            exec_command(ec2, clients, cache, opts)
+        elif action == "push":
+            push_files(ec2, clients, cache, opts)
+        elif action == "serve":
+            from eyws.server import serve
+
+            serve(opts.socket, execute)
         else:
             print("'{}' not supported!".format(action))
 
@@ -688,49 +1388,9 @@ def error(msg=None):
     sys.exit(1)
 
 
-def split_emails(option, opt, value, parser):
+def split_commas(option, opt, value, parser):
     setattr(parser.values, option.dest, value.split(','))
 
 
-class ServiceUsageCost:
-
-    def __init__(self, account, service_name, cost: Decimal, unit) -> None:
-        self.account = account
-        self.service_name = service_name
-        self.cost = cost
-        self.unit = unit
-
-    def as_tuple(self):
-        return self.service_name, self.cost, self.unit
-
-
-class PeriodicCosts:
-
-    def __init__(self, period) -> None:
-        self.period = period
-        self.account_service_usage = defaultdict(list)  # after sorting => [ ("account XYZ", [(), (), ()]), (...) ]
-        self.total = 0
-        self.account_total = {}
-
-    def add_cost(self, service_usage_cost: ServiceUsageCost):
-        self.account_service_usage[service_usage_cost.account].append(service_usage_cost.as_tuple())
-        self.total += service_usage_cost.cost
-
-        self.account_total[service_usage_cost.account] = service_usage_cost.cost \
-            if service_usage_cost.account not in self.account_total else \
-            self.account_total[service_usage_cost.account] + service_usage_cost.cost
-
-    def prettify(self):
-        print("\n{} - {} USD".format(self.period, self.total))
-
-        for account, costs in self.account_service_usage:
-            print("\n\t{}\n".format(account))
-            for service_cost in costs:
-                if service_cost[0]:
-                    print("\t\t{} {}\t{}".format(service_cost[1], service_cost[2], service_cost[0]))
-            print("\t\t------------")
-            print("\t\t{} USD".format(self.account_total[account]))
-
-
 if __name__ == "__main__":
     execute()
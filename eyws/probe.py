@@ -0,0 +1,79 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import queue
+import threading
+
+SSH_PORT = 22
+DEFAULT_PROBE_INTERVAL = 1.0  # seconds between connection attempts
+DEFAULT_PROBE_TIMEOUT = 300  # seconds to wait for a host before giving up
+
+
+async def wait_for_port(host, port=SSH_PORT, interval=DEFAULT_PROBE_INTERVAL, timeout=DEFAULT_PROBE_TIMEOUT):
+    """Polls host until it accepts TCP connections on port, returns False if it didn't within timeout"""
+    loop = asyncio.get_event_loop()
+    deadline = loop.time() + timeout
+
+    while True:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout=max(interval, 1.0))
+            writer.close()
+            return True
+        except (OSError, asyncio.TimeoutError):
+            if loop.time() >= deadline:
+                return False
+            await asyncio.sleep(interval)
+
+
+def wait_for(host, port=SSH_PORT, interval=DEFAULT_PROBE_INTERVAL, timeout=DEFAULT_PROBE_TIMEOUT):
+    """Blocking wait_for_port, for threads without an event loop"""
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(wait_for_port(host, port, interval, timeout))
+    finally:
+        loop.close()
+
+
+def as_ready(items, address=lambda item: item, port=SSH_PORT, interval=DEFAULT_PROBE_INTERVAL,
+             timeout=DEFAULT_PROBE_TIMEOUT):
+    """Probes every item's address concurrently.
+
+    Yields (item, ready) pairs in the order the hosts come up, so callers can start working on a host as
+    soon as it accepts connections. Hosts that never do are yielded with ready=False after timeout.
+    """
+    items = list(items)
+    results = queue.Queue()
+
+    async def probe(item):
+        try:
+            ready = await wait_for_port(address(item), port, interval, timeout)
+        except Exception:
+            ready = False
+        results.put((item, ready))
+
+    async def probe_all():
+        await asyncio.gather(*[probe(item) for item in items])
+
+    def run():
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(probe_all())
+        finally:
+            loop.close()
+
+    threading.Thread(target=run, daemon=True).start()
+
+    for _ in items:
+        yield results.get()
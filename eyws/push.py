@@ -0,0 +1,159 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import posixpath
+import shutil
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from eyws import ssh
+from eyws.fanout import DEFAULT_PARALLELISM, host_print
+from eyws.remote import TIMED_OUT, instance_address, run_captured
+
+RSYNC_UNAVAILABLE = [12, 127]  # rsync exit codes when it's missing on the other side
+
+
+def copy(opts, source, destination, timeout=None, relay=None):
+    """Copies source to destination with rsync, falls back to scp when either side has no rsync.
+
+    Without a relay the copy runs on this machine. With one it runs on the relay host over an ssh connection
+    forwarding the local ssh agent, so the relay can log in to the destination host with the same key.
+    Returns the name of the tool that copied the files.
+    """
+    def run(args):
+        if relay is not None:
+            args = ssh.ssh_command(opts) + ["-A", "%s@%s" % (opts.user, relay), ssh.stringify_command(args)]
+        return run_captured(args, timeout)
+
+    identity = relay is None  # the relay has no copy of the identity file, the forwarded agent has the key
+    tools = [("rsync", ssh.rsync_command), ("scp", ssh.scp_command)]
+    if relay is None and shutil.which("rsync") is None:
+        tools = tools[1:]
+
+    for tool, command in tools:
+        exit_code, _, stderr = run(command(opts, source, destination, identity))
+        if exit_code == 0:
+            return tool
+        if tool == "rsync" and exit_code in RSYNC_UNAVAILABLE:
+            continue
+        if exit_code == TIMED_OUT:
+            raise Exception("{} timed out".format(tool))
+        raise Exception("{} failed with exit code {}: {}".format(tool, exit_code, stderr.strip()))
+
+
+def landed_path(opts, host, source, destination, timeout=None):
+    """Where a copy of source to destination landed on host, with a trailing slash when it's a directory.
+
+    That's destination/<name of source> when destination is an existing directory, destination itself
+    otherwise, which only the remote host can tell.
+    """
+    candidates = [destination]
+    if not source.endswith("/"):  # a trailing slash copies the contents of a directory into destination
+        candidates.insert(0, posixpath.join(destination, os.path.basename(source)))
+    # the remote shell starts in the home directory, quoted paths can't start with ~
+    candidates = [path[2:] if path.startswith("~/") else path for path in candidates]
+
+    script = 'for p in {}; do if [ -e "$p" ]; then if [ -d "$p" ]; then echo "$p/"; else echo "$p"; fi; break; fi; ' \
+             'done'.format(ssh.stringify_command(candidates))
+    exit_code, stdout, stderr = run_captured(ssh.ssh_command(opts) + ["%s@%s" % (opts.user, host), script], timeout)
+    path = stdout.strip() if exit_code == 0 else ""
+    if not path:
+        raise Exception("can't find {} on {}: {}".format(destination, host, stderr.strip()))
+    return path
+
+
+class Push:
+    """Copies a local file or directory to many instances.
+
+    Without relaying, up to workers instances are copied to from this machine at the same time. With relaying
+    this machine seeds a single instance at a time and every instance that received the files seeds the next
+    one over private IPs, copying them to the same path they landed at. So the number of copies doubles in each
+    round while the local upload is paid about once. An instance failing to receive the files from another
+    instance gets them from this machine instead.
+    """
+
+    def __init__(self, opts, instances, source, destination, relay=False, workers=DEFAULT_PARALLELISM,
+                 timeout=None) -> None:
+        self.opts = opts
+        self.instances = instances
+        self.source = source
+        self.destination = destination
+        self.relay = relay
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self._landed = {}  # seed instance id => landed_path on it
+
+    def run(self):
+        """Copies to every instance, returns (succeeded, failed) like fan_out"""
+        succeeded = []
+        failed = []
+        pending = deque(self.instances)
+        direct = deque()  # instances to copy to from this machine only
+        seeds = deque([None] * (1 if self.relay else self.workers))  # None is this machine
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while pending or direct or running:
+                for seed in list(seeds):
+                    if len(running) >= self.workers:
+                        break
+                    queue = direct if seed is None and direct else pending
+                    if not queue:
+                        continue
+                    seeds.remove(seed)
+                    instance = queue.popleft()
+                    running[pool.submit(self._copy, seed, instance)] = (seed, instance)
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    seed, instance = running.pop(future)
+                    seeds.append(seed)
+                    instance_id = instance["InstanceId"]
+                    try:
+                        future.result()
+                    except Exception as e:
+                        if seed is None:
+                            host_print(instance_id, "failed: {}".format(e), file=sys.stderr)
+                            failed.append((instance_id, e))
+                        else:
+                            host_print(instance_id, "failed to copy from {}, copying from here instead: {}"
+                                       .format(seed["InstanceId"], e), file=sys.stderr)
+                            direct.append(instance)
+                    else:
+                        succeeded.append(instance_id)
+                        if self.relay:
+                            seeds.append(instance)
+
+        return succeeded, failed
+
+    def _copy(self, seed, instance):
+        started = time.monotonic()
+        if seed is None:
+            tool = copy(self.opts, self.source, "%s@%s:%s" % (self.opts.user, instance_address(instance),
+                                                              self.destination), self.timeout)
+            origin = "here"
+        else:
+            relay = instance_address(seed)
+            path = self._landed.get(seed["InstanceId"])
+            if path is None:
+                path = self._landed[seed["InstanceId"]] = landed_path(self.opts, relay, self.source,
+                                                                      self.destination, self.timeout)
+            tool = copy(self.opts, path, "%s@%s:%s" % (self.opts.user, instance["PrivateIpAddress"],
+                                                       path.rstrip("/") or "/"), self.timeout, relay=relay)
+            origin = seed["InstanceId"]
+        host_print(instance["InstanceId"], "copied from {} with {} in {:.1f}s".format(origin, tool,
+                                                                                   time.monotonic() - started))
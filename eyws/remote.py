@@ -0,0 +1,113 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from eyws import ssh
+from eyws.fanout import DEFAULT_PARALLELISM, host_print
+
+TIMED_OUT = "timeout"  # exit code of commands killed after the host timeout
+
+
+class CommandResult:
+    """Outcome of a command run on one instance, exit_code is TIMED_OUT when it was killed"""
+
+    def __init__(self, instance_id, host, exit_code, stdout, stderr, seconds) -> None:
+        self.instance_id = instance_id
+        self.host = host
+        self.exit_code = exit_code
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+
+    @property
+    def ok(self):
+        return self.exit_code == 0
+
+    @property
+    def status(self):
+        if self.exit_code == TIMED_OUT:
+            return "timed out"
+        if self.exit_code == ssh.SSH_TRANSPORT_ERROR:
+            return "exit {} (ssh failed)".format(self.exit_code)
+        return "exit {}".format(self.exit_code)
+
+
+def instance_address(instance):
+    """Public DNS name of an instance, its private IP when it has none"""
+    return instance.get("PublicDnsName") or instance.get("PrivateIpAddress")
+
+
+def run_command(opts, instance, command, timeout=None):
+    """Runs command on an instance and captures its output.
+
+    No tty is allocated so stdout and stderr stay apart. The local ssh process is killed when the command is
+    still running after timeout seconds, the remote command may outlive it.
+    """
+    host = instance_address(instance)
+    started = time.monotonic()
+    exit_code, stdout, stderr = run_captured(ssh.ssh_command(opts) + ["%s@%s" % (opts.user, host),
+                                                                      ssh.stringify_command(command)], timeout)
+    return CommandResult(instance["InstanceId"], host, exit_code, stdout, stderr, time.monotonic() - started)
+
+
+def run_captured(args, timeout=None):
+    """Runs args without stdin, returns (exit code, stdout, stderr); TIMED_OUT when it's killed after timeout"""
+    proc = subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout or None)
+        return proc.returncode, stdout, stderr
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        stdout, stderr = proc.communicate()
+        return TIMED_OUT, stdout, stderr
+
+
+def run_on_instances(opts, instances, command, timeout=None, workers=DEFAULT_PARALLELISM):
+    """Runs command on every instance on a bounded pool of workers, yields CommandResults as they complete"""
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = [pool.submit(run_command, opts, instance, command, timeout) for instance in instances]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def print_result(result):
+    for line in result.stdout.splitlines():
+        host_print(result.instance_id, line)
+    for line in result.stderr.splitlines():
+        host_print(result.instance_id, line, file=sys.stderr)
+    host_print(result.instance_id, "{} after {:.1f}s".format(result.status, result.seconds),
+               file=sys.stdout if result.ok else sys.stderr)
+
+
+def print_exit_codes(results, skipped=()):
+    """Prints the instances grouped by the exit code of their command, successful ones first.
+
+    skipped holds the ids of instances the command wasn't run on.
+    """
+    groups = OrderedDict()
+    for result in sorted(results, key=lambda r: (not r.ok, str(r.exit_code), r.instance_id)):
+        groups.setdefault(result.status, []).append(result.instance_id)
+    if skipped:
+        groups["skipped"] = sorted(skipped)
+
+    print("\n{} of {} instances succeeded".format(sum(1 for result in results if result.ok),
+                                                  len(results) + len(skipped)))
+    for status, instance_ids in groups.items():
+        print("\t{}\t{}\t{}".format(status, len(instance_ids), " ".join(instance_ids)))
@@ -0,0 +1,169 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""eyws serve daemon and its thin client.
+
+The daemon keeps modules, sessions and clients loaded and runs every request's arguments through execute().
+Requests and responses are JSON lines over a Unix socket: the client sends {"argv": [...], "cwd": "..."}, the
+daemon streams back {"stdout": "..."} and {"stderr": "..."} as the action prints and ends with {"exit": code}.
+"""
+
+import json
+import os
+import socket
+import sys
+import threading
+
+DEFAULT_SOCKET = os.environ.get("EYWS_SOCKET", os.path.join(os.path.expanduser("~"), ".cache", "eyws", "eyws.sock"))
+
+
+class _JsonLinesStream:
+    """Text stream sending every write as a JSON line named after the stream"""
+
+    def __init__(self, wfile, name, lock) -> None:
+        self.wfile = wfile
+        self.name = name
+        self.lock = lock
+
+    def write(self, data):
+        if data:
+            with self.lock:
+                self.wfile.write((json.dumps({self.name: data}) + "\n").encode("utf-8"))
+                self.wfile.flush()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+
+def _exit_code(e: SystemExit):
+    if e.code is None:
+        return 0
+    return e.code if isinstance(e.code, int) else 1
+
+
+def serve(path, execute):
+    """Serves execute(argv, factories) requests on the Unix socket path until interrupted.
+
+    Requests are handled one at a time since an action's output is captured by redirecting sys.stdout and
+    sys.stderr, which the worker threads of its fan-outs print to as well. Actions read stdin from /dev/null:
+    the client can't answer prompts, and a daemon started in the background of a terminal would be stopped by
+    reading from it.
+    """
+    import socketserver
+    from contextlib import redirect_stderr, redirect_stdout
+
+    factories = {}  # warm client factories shared by all requests
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            line = self.rfile.readline()
+            if not line:
+                return  # a connection probe, see _is_listening
+
+            request = json.loads(line.decode("utf-8"))
+            lock = threading.Lock()
+            cwd = os.getcwd()
+            code = 0
+
+            with redirect_stdout(_JsonLinesStream(self.wfile, "stdout", lock)), \
+                    redirect_stderr(_JsonLinesStream(self.wfile, "stderr", lock)):
+                try:
+                    os.chdir(request.get("cwd", cwd))
+                    execute(request["argv"], factories)
+                except SystemExit as e:
+                    code = _exit_code(e)
+                except Exception as e:
+                    print(e, file=sys.stderr)
+                    code = 1
+                finally:
+                    os.chdir(cwd)
+
+            self.wfile.write((json.dumps({"exit": code}) + "\n").encode("utf-8"))
+
+    if os.path.exists(path):
+        if _is_listening(path):
+            raise ValueError("eyws is already serving on {}".format(path))
+        os.remove(path)  # left behind by a daemon that didn't shut down cleanly
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    umask = os.umask(0o077)  # only the user may connect
+    try:
+        server = socketserver.UnixStreamServer(path, Handler)
+    finally:
+        os.umask(umask)
+
+    print("serving on {}...".format(path))
+    stdin = sys.stdin
+    try:
+        with open(os.devnull) as sys.stdin:
+            server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdin = stdin
+        server.server_close()
+        os.remove(path)
+
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+
+def call(argv, path=DEFAULT_SOCKET, stdout=None, stderr=None):
+    """Runs argv on the daemon listening on path, copies its output and returns its exit code"""
+    streams = {"stdout": stdout or sys.stdout, "stderr": stderr or sys.stderr}
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        sock.sendall((json.dumps({"argv": argv, "cwd": os.getcwd()}) + "\n").encode("utf-8"))
+
+        for line in sock.makefile("rb"):
+            message = json.loads(line.decode("utf-8"))
+            if "exit" in message:
+                return message["exit"]
+            for name, data in message.items():
+                streams[name].write(data)
+                streams[name].flush()
+    finally:
+        sock.close()
+
+    raise ConnectionError("eyws daemon on {} closed the connection".format(path))
+
+
+def main():
+    """eyws-client: forwards its arguments to a running `eyws serve` (socket path from $EYWS_SOCKET)"""
+    try:
+        code = call(sys.argv[1:])
+    except OSError as e:
+        print("Can't reach eyws daemon on {}, start it with `eyws serve`: {}".format(DEFAULT_SOCKET, e),
+              file=sys.stderr)
+        code = 1
+    sys.exit(code)
+
+
+if __name__ == "__main__":
+    main()
@@ -12,44 +12,198 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import pipes
+import random
+import shutil
 import subprocess
+import tempfile
+import threading
 import time
 from sys import stderr
 
+from eyws.fanout import host_print
+
+
+CONTROL_PERSIST_SECONDS = 60
+DEFAULT_SSH_TIMEOUT = 10  # seconds to wait for each connection attempt
+DEFAULT_SSH_MAX_WAIT = 300  # seconds to keep retrying a host that isn't reachable yet
+SSH_TRANSPORT_ERROR = 255  # exit code of ssh itself failing, as opposed to the remote command
+OUTPUT_DRAIN_TIMEOUT = 2  # seconds to keep reading output left in the pipe after ssh exited
+
+
+class RetryPolicy:
+    """Decides which failed ssh calls are retried and how long to wait in between.
+
+    Transport failures (ssh exiting with 255, e.g. a refused connection on a still booting host) are
+    retried with exponential backoff and full jitter until max_wait seconds have passed. Failing remote
+    commands are not retried unless retry_commands is set.
+    """
+
+    def __init__(self, max_wait=DEFAULT_SSH_MAX_WAIT, base_delay=1.0, max_delay=15.0, retry_commands=False) -> None:
+        self.max_wait = max_wait
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_commands = retry_commands
+
+    def should_retry(self, returncode):
+        return returncode == SSH_TRANSPORT_ERROR or self.retry_commands
+
+    def delays(self):
+        """Yields the seconds to sleep before each retry, stops when the deadline is reached"""
+        deadline = time.monotonic() + self.max_wait
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            yield min(remaining, random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+            attempt += 1
+
+
+def ssh(host, opts, command, prefix=None, control_path=None, stdin=None, on_line=None, policy=None):
+    """Run a command on host, retrying failed attempts as the retry policy allows.
+
+    Output goes straight to the terminal unless a prefix or an on_line callback is given. When stdin text is
+    given it's fed to the remote command and no tty is allocated.
+    """
+    if on_line is None and prefix is not None:
+        def on_line(line):
+            host_print(prefix, line)
+
+    if policy is None:
+        policy = RetryPolicy(max_wait=opts.ssh_max_wait)
+    delays = policy.delays()
 
-def ssh(host, opts, command):
-    tries = 0
     while True:
         try:
-            return subprocess.check_call(
-                ssh_command(opts) + ['-t', '-t', '%s@%s' % (opts.user, host), stringify_command(command)])
+            args = ssh_command(opts, control_path) + \
+                   (['-t', '-t'] if stdin is None else []) + \
+                   ['%s@%s' % (opts.user, host), stringify_command(command)]
+            if on_line is not None:
+                return check_call_streamed(args, on_line, stdin)
+            if stdin is None:
+                return subprocess.check_call(args)
+            return subprocess.run(args, input=stdin, universal_newlines=True, check=True).returncode
         except subprocess.CalledProcessError as e:
-            if tries > 5:
-                if e.returncode == 255:
+            delay = next(delays, None) if policy.should_retry(e.returncode) else None
+            if delay is None:
+                if e.returncode == SSH_TRANSPORT_ERROR:
                     raise Exception(
-                        "Failed to SSH to remote host {0}.\n" +
-                        "Please check that you have provided the correct --identity and " +
-                        "--key-pair parameters and try again.".format(host))
+                        ("Failed to SSH to remote host {0}.\n" +
+                         "Please check that you have provided the correct --identity and " +
+                         "--key-pair parameters and try again.").format(host))
                 else:
                     raise e
-            print("Error executing remote command, retrying after 15 seconds: {0}".format(e),
-                  file=stderr)
-            time.sleep(15)
+            msg = "SSH attempt failed, retrying after {0:.1f} seconds: {1}".format(delay, e)
+            if prefix is None:
+                print(msg, file=stderr)
+            else:
+                host_print(prefix, msg, file=stderr)
+            time.sleep(delay)
+
 
+def check_call_streamed(args, on_line, stdin=None):
+    """Like subprocess.check_call, but every output line is handed to on_line as soon as it's read.
 
-def ssh_command(opts):
-    return ['ssh'] + ssh_args(opts)
+    Returns once the process exited and its remaining output is read, without waiting for the end of its output:
+    a ControlPersist master forked by ssh may keep the pipe open long after.
+    """
+    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                            stdin=subprocess.DEVNULL if stdin is None else subprocess.PIPE,
+                            universal_newlines=True)
+
+    if stdin is not None:
+        # feed stdin from another thread, remote side may start writing output before it has read everything
+        def feed():
+            try:
+                proc.stdin.write(stdin)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        threading.Thread(target=feed, daemon=True).start()
+
+    def read():
+        try:
+            for line in proc.stdout:
+                on_line(line.rstrip("\r\n"))
+        finally:
+            proc.stdout.close()
 
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
 
-def ssh_args(opts):
+    returncode = proc.wait()
+    reader.join(OUTPUT_DRAIN_TIMEOUT)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, args)
+    return returncode
+
+
+def ssh_command(opts, control_path=None, identity=True):
+    return ['ssh'] + ssh_args(opts, control_path, identity)
+
+
+def ssh_args(opts, control_path=None, identity=True):
     parts = ['-o', 'StrictHostKeyChecking=no']
     parts += ['-o', 'UserKnownHostsFile=/dev/null']
-    if opts.identity is not None:
+    if identity and opts.identity is not None:
         parts += ['-i', opts.identity]
+    if opts.ssh_timeout:
+        parts += ['-o', 'ConnectTimeout=%d' % opts.ssh_timeout]
+    if control_path is not None:
+        parts += ['-o', 'ControlMaster=auto']
+        parts += ['-o', 'ControlPath=%s' % control_path]
+        parts += ['-o', 'ControlPersist=%d' % CONTROL_PERSIST_SECONDS]
     return parts
 
 
+def rsync_command(opts, source, destination, identity=True):
+    """rsync over ssh, compressed and skipping files whose checksum matches the destination's"""
+    return ['rsync', '-a', '-z', '--checksum', '-e', stringify_command(ssh_command(opts, identity=identity)),
+            source, destination]
+
+
+def scp_command(opts, source, destination, identity=True):
+    """Compressed, recursive scp for hosts without rsync, copies every file again"""
+    return ['scp', '-C', '-r', '-q'] + ssh_args(opts, identity=identity) + [source, destination]
+
+
+class Session:
+    """Multiplexed ssh connection to a single host.
+
+    The first command opens a master connection (ControlMaster) and every later command is sent over it,
+    so the TCP and key exchange handshake is paid only once per host. Use it as a context manager to make
+    sure the master connection is closed when done.
+    """
+
+    def __init__(self, host, opts, prefix=None) -> None:
+        self.host = host
+        self.opts = opts
+        self.prefix = prefix
+        # unix socket paths are limited to ~100 chars, so keep a short name in a private directory
+        self.control_dir = tempfile.mkdtemp(prefix="eyws-")
+        self.control_path = os.path.join(self.control_dir, "master")
+
+    def run(self, command, stdin=None, on_line=None):
+        return ssh(self.host, self.opts, command, prefix=self.prefix, control_path=self.control_path,
+                   stdin=stdin, on_line=on_line)
+
+    def close(self):
+        if os.path.exists(self.control_path):
+            subprocess.call(ssh_command(self.opts, self.control_path) +
+                            ['-O', 'exit', '%s@%s' % (self.opts.user, self.host)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(self.control_dir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def stringify_command(parts):
     if isinstance(parts, str):
         return parts
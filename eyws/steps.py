@@ -0,0 +1,88 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from collections import namedtuple
+
+from eyws.fanout import host_print
+
+STEP_MARKER = "::eyws-step::"
+
+StepResult = namedtuple("StepResult", ["index", "command", "returncode", "seconds"])
+
+
+class StepPipeline:
+    """Ordered list of shell commands run on a host as a single remote script.
+
+    The script is fed to 'bash -s' over one ssh session. Each step reports its start and exit code back
+    through marker lines, and the index of the last completed step is kept in ~/.eyws/<name>.state on the
+    host, so running the pipeline again after a failure resumes from the failing step.
+    """
+
+    def __init__(self, name, steps) -> None:
+        self.name = name
+        self.steps = list(steps)
+
+    def script(self):
+        lines = ["mkdir -p \"$HOME/.eyws\"",
+                 "state=\"$HOME/.eyws/{}.state\"".format(self.name),
+                 "completed=$(cat \"$state\" 2>/dev/null || echo 0)"]
+
+        for i, step in enumerate(self.steps, start=1):
+            lines += ["if [ \"$completed\" -lt {i} ]; then".format(i=i),
+                      "echo \"{m} start {i}\"".format(m=STEP_MARKER, i=i),
+                      "(\n{}\n) < /dev/null".format(step),
+                      "rc=$?",
+                      "echo \"{m} end {i} $rc\"".format(m=STEP_MARKER, i=i),
+                      "[ $rc -eq 0 ] || exit $rc",
+                      "echo {i} > \"$state\"".format(i=i),
+                      "else",
+                      "echo \"{m} skip {i}\"".format(m=STEP_MARKER, i=i),
+                      "fi"]
+
+        lines.append("rm -f \"$state\"")
+        return "\n".join(lines) + "\n"
+
+    def run(self, session):
+        """Run the pipeline over an ssh.Session, returns a list of StepResult for the steps executed"""
+        prefix = session.prefix if session.prefix else session.host
+        results = []
+        started = {}
+
+        def on_line(line):
+            if not line.startswith(STEP_MARKER):
+                host_print(prefix, line)
+                return
+
+            fields = line[len(STEP_MARKER):].split()
+            event, index = fields[0], int(fields[1])
+            command = self.steps[index - 1]
+
+            if event == "start":
+                started[index] = time.monotonic()
+            elif event == "skip":
+                host_print(prefix, "step {}/{} already done, skipping: {}".format(index, len(self.steps), command))
+            elif event == "end":
+                returncode = int(fields[2])
+                seconds = time.monotonic() - started.pop(index, time.monotonic())
+                results.append(StepResult(index, command, returncode, seconds))
+                host_print(prefix, "step {}/{} {} in {:.1f}s: {}".format(index,
+                                                                       len(self.steps),
+                                                                       "ok" if returncode == 0 else
+                                                                       "failed ({})".format(returncode),
+                                                                       seconds,
+                                                                       command))
+
+        session.run("bash -s", stdin=self.script(), on_line=on_line)
+        return results
@@ -0,0 +1,103 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from eyws.fanout import DEFAULT_PARALLELISM
+
+DEFAULT_WAIT_INTERVAL = 5.0  # seconds between polls
+DEFAULT_WAIT_TIMEOUT = 600
+MAX_STATUS_IDS = 100  # instance ids describe_instance_status accepts per call
+
+# waiter name => (target state, states the target can't be reached from), like botocore's waiters
+WAITERS = {
+    "instance_running": ("running", ["shutting-down", "terminated", "stopping"]),
+    "instance_stopped": ("stopped", ["pending", "terminated"]),
+    "instance_terminated": ("terminated", ["pending", "stopping"]),
+}
+
+
+def describe_states(ec2, instance_ids):
+    """{instance id: state name} of the given instances, at most MAX_STATUS_IDS of them"""
+    states = {}
+    kwargs = {"InstanceIds": instance_ids, "IncludeAllInstances": True}
+    while True:
+        resp = ec2.describe_instance_status(**kwargs)
+
+        for status in resp["InstanceStatuses"]:
+            states[status["InstanceId"]] = status["InstanceState"]["Name"]
+
+        token = resp.get("NextToken")
+        if not token:
+            break
+        kwargs["NextToken"] = token
+
+    return states
+
+
+def visible_states(ec2, instance_ids):
+    """{instance id: state name} of instances, polled in batches of MAX_STATUS_IDS.
+
+    Just launched instances may not be visible yet, a batch failing with InvalidInstanceID.NotFound is left out
+    to be polled again next time.
+    """
+    from botocore.exceptions import ClientError
+
+    states = {}
+    for i in range(0, len(instance_ids), MAX_STATUS_IDS):
+        try:
+            states.update(describe_states(ec2, instance_ids[i:i + MAX_STATUS_IDS]))
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "InvalidInstanceID.NotFound":
+                raise
+    return states
+
+
+def as_reached(ec2, instance_ids, waiter_name="instance_running", interval=DEFAULT_WAIT_INTERVAL,
+               timeout=DEFAULT_WAIT_TIMEOUT, workers=DEFAULT_PARALLELISM):
+    """Polls instance states until every instance reached the state of waiter_name.
+
+    Yields (instance id, state) for each instance as soon as it's in the target state or in one it can't get
+    there from; those still pending after timeout are yielded with their last known state. Instances are polled
+    in batches of MAX_STATUS_IDS, concurrently.
+    """
+    target, failure_states = WAITERS[waiter_name]
+    pending = {instance_id: None for instance_id in instance_ids}
+    deadline = time.monotonic() + timeout
+
+    def poll(batch):
+        return visible_states(ec2, batch)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        while pending:
+            ids = list(pending)
+            batches = [ids[i:i + MAX_STATUS_IDS] for i in range(0, len(ids), MAX_STATUS_IDS)]
+
+            for states in pool.map(poll, batches):
+                for instance_id, state in states.items():
+                    if instance_id not in pending:
+                        continue
+                    pending[instance_id] = state
+                    if state == target or state in failure_states:
+                        del pending[instance_id]
+                        yield instance_id, state
+
+            if pending and time.monotonic() + interval > deadline:
+                break
+            if pending:
+                time.sleep(interval)
+
+    for instance_id, state in pending.items():
+        yield instance_id, state
@@ -18,8 +18,8 @@ from eyws.about import __version__, __author__, __license__, __email__, __descri
 requires = [
     "jinja2>=2.10",
     "python-dateutil>= 2.7.3",
-    "boto3==1.8.1",
-    "botocore==1.11.1",
+    "boto3==1.12.0",
+    "botocore==1.15.0",
 ]
 
 
@@ -43,7 +43,8 @@ setuptools.setup(
     include_package_data=False,
     entry_points={
         "console_scripts": [
-            "eyws = eyws.parser:execute"
+            "eyws = eyws.parser:execute",
+            "eyws-client = eyws.server:main"
         ]
     },
     zip_safe=False,
@@ -0,0 +1,148 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import sqlite3
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+import pytest
+
+from eyws.coststore import RESYNC_DAYS, CostStore
+
+ACCOUNT = "123456789012"
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = CostStore(str(tmp_path / "costs.db"))
+    yield store
+    store.close()
+
+
+def daily(day, *groups):
+    """DAILY Cost Explorer period of day with (linked account, service, amount) groups"""
+    return {"TimePeriod": {"Start": day, "End": day},
+            "Groups": [{"Keys": [account, service], "Metrics": {"BlendedCost": {"Amount": amount, "Unit": "USD"}}}
+                       for account, service, amount in groups]}
+
+
+def days_before(day, days):
+    return (datetime.strptime(day, "%Y-%m-%d") - timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+def amounts(periods):
+    return {(period["TimePeriod"]["Start"], tuple(group["Keys"])): Decimal(group["Metrics"]["BlendedCost"]["Amount"])
+            for period in periods for group in period["Groups"]}
+
+
+def test_first_sync_fetches_the_whole_range(store):
+    assert store.synced_range(ACCOUNT) is None
+    assert store.sync_ranges(ACCOUNT, "2026-09-01", "2026-09-20") == [("2026-09-01", "2026-09-20")]
+
+
+def test_sync_fetches_the_last_days_again_along_with_the_new_ones(store):
+    store.replace_days(ACCOUNT, "2026-09-01", "2026-09-20", [])
+
+    assert store.synced_range(ACCOUNT) == ("2026-09-01", "2026-09-20")
+    assert store.sync_ranges(ACCOUNT, "2026-09-01", "2026-09-25") == \
+        [(days_before("2026-09-20", RESYNC_DAYS), "2026-09-25")]
+    # the synced days are refreshed even when nothing new is asked for
+    assert store.sync_ranges(ACCOUNT, "2026-09-10", "2026-09-20") == \
+        [(days_before("2026-09-20", RESYNC_DAYS), "2026-09-20")]
+
+
+def test_sync_backfills_days_before_the_synced_ones(store):
+    store.replace_days(ACCOUNT, "2026-09-01", "2026-09-20", [])
+
+    assert store.sync_ranges(ACCOUNT, "2026-07-01", "2026-09-20") == \
+        [("2026-07-01", "2026-09-01"), (days_before("2026-09-20", RESYNC_DAYS), "2026-09-20")]
+
+    store.replace_days(ACCOUNT, "2026-07-01", "2026-09-01", [])
+    assert store.synced_range(ACCOUNT) == ("2026-07-01", "2026-09-20")
+
+
+def test_resync_doesnt_reach_before_the_synced_days(store):
+    store.replace_days(ACCOUNT, "2026-09-19", "2026-09-20", [])
+
+    assert store.sync_ranges(ACCOUNT, "2026-09-19", "2026-09-21") == [("2026-09-19", "2026-09-21")]
+
+
+def test_replace_days_replaces_only_the_given_days(store):
+    store.replace_days(ACCOUNT, "2026-09-01", "2026-09-03", [daily("2026-09-01", ("111", "EC2", "1.5")),
+                                                            daily("2026-09-02", ("111", "EC2", "2"),
+                                                                  ("111", "S3", "0.25"))])
+    store.replace_days(ACCOUNT, "2026-09-02", "2026-09-03", [daily("2026-09-02", ("111", "EC2", "3"))])
+
+    assert amounts(store.periods(ACCOUNT, "2026-09-01", "2026-09-03", "day")) == {
+        ("2026-09-01", ("111", "EC2")): Decimal("1.5"),
+        ("2026-09-02", ("111", "EC2")): Decimal("3"),
+    }
+
+
+@pytest.fixture
+def synced(store):
+    store.replace_days(ACCOUNT, "2026-08-30", "2026-09-08", [
+        daily("2026-08-30", ("111", "EC2", "0.1"), ("222", "EC2", "5")),
+        daily("2026-08-31", ("111", "EC2", "0.2"), ("111", "S3", "0.0000001")),
+        daily("2026-09-01", ("111", "EC2", "0.3")),
+        daily("2026-09-06", ("111", "EC2", "0.4")),
+        daily("2026-09-07", ("111", "EC2", "0.5")),
+    ])
+    return store
+
+
+def test_periods_roll_up_by_month(synced):
+    assert amounts(synced.periods(ACCOUNT, "2026-08-01", "2026-10-01", "month")) == {
+        ("2026-08-01", ("111", "EC2")): Decimal("0.3"),
+        ("2026-08-01", ("111", "S3")): Decimal("0.0000001"),
+        ("2026-08-01", ("222", "EC2")): Decimal("5"),
+        ("2026-09-01", ("111", "EC2")): Decimal("1.2"),
+    }
+
+
+def test_periods_roll_up_by_week_starting_on_monday(synced):
+    periods = synced.periods(ACCOUNT, "2026-08-01", "2026-10-01", "week")
+
+    assert [(period["TimePeriod"]["Start"], period["TimePeriod"]["End"]) for period in periods] == \
+        [("2026-08-24", "2026-08-31"), ("2026-08-31", "2026-09-07"), ("2026-09-07", "2026-09-14")]
+    assert amounts(periods)[("2026-08-31", ("111", "EC2"))] == Decimal("0.9")
+
+
+def test_periods_roll_up_by_day_within_the_range(synced):
+    periods = synced.periods(ACCOUNT, "2026-08-31", "2026-09-07", "day")
+
+    assert [period["TimePeriod"]["Start"] for period in periods] == ["2026-08-31", "2026-09-01", "2026-09-06"]
+
+
+def test_periods_without_services_sum_every_service_of_an_account(synced):
+    assert amounts(synced.periods(ACCOUNT, "2026-08-01", "2026-09-01", "month", by_service=False)) == {
+        ("2026-08-01", ("111",)): Decimal("0.3000001"),
+        ("2026-08-01", ("222",)): Decimal("5"),
+    }
+
+
+def test_stores_without_synced_from_are_migrated(tmp_path):
+    path = str(tmp_path / "costs.db")
+    db = sqlite3.connect(path)
+    with db:
+        db.execute("CREATE TABLE sync_state (account_id TEXT PRIMARY KEY, synced_until TEXT NOT NULL)")
+        db.execute("INSERT INTO sync_state VALUES (?, ?)", (ACCOUNT, "2026-09-20"))
+    db.close()
+
+    store = CostStore(path)
+    try:
+        store.replace_days(ACCOUNT, "2026-09-10", "2026-09-11", [daily("2026-09-10", ("111", "EC2", "1"))])
+        assert store.synced_range(ACCOUNT) == ("2026-09-10", "2026-09-20")
+    finally:
+        store.close()
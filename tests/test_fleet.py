@@ -0,0 +1,122 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+from eyws.fleet import Fleet
+
+INTERVAL = 0.05
+
+
+def launched(*instance_ids):
+    return [{"InstanceId": instance_id, "State": {"Name": "pending"}} for instance_id in instance_ids]
+
+
+class FakeEC2:
+    """states and describe of a Fleet, every instance runs through its list of states staying at the last one.
+
+    None is a state of an instance that isn't visible yet.
+    """
+
+    def __init__(self, states) -> None:
+        self.timeline = {instance_id: list(states) for instance_id, states in states.items()}
+        self.polled = []
+        self.described = []
+
+    def states(self, instance_ids):
+        self.polled.append(sorted(instance_ids))
+        states = {}
+        for instance_id in instance_ids:
+            timeline = self.timeline[instance_id]
+            state = timeline.pop(0) if len(timeline) > 1 else timeline[0]
+            if state is not None:
+                states[instance_id] = state
+        return states
+
+    def describe(self, instance_ids):
+        self.described.append(sorted(instance_ids))
+        return [{"InstanceId": instance_id, "PublicDnsName": "{}.example.com".format(instance_id)}
+                for instance_id in instance_ids]
+
+
+def ids(members):
+    return sorted(member.instance_id for member in members)
+
+
+def test_instances_run_independently_of_each_other():
+    # i-1 isn't visible on the first poll, i-2 runs on the first poll
+    ec2 = FakeEC2({"i-0": ["pending", "pending", "running"], "i-1": [None, "running"], "i-2": ["running"]})
+    fleet = Fleet(launched("i-0", "i-1", "i-2"), ec2.states, ec2.describe, interval=INTERVAL, timeout=10)
+
+    succeeded, failed = fleet.run()
+
+    assert ids(succeeded) == ["i-0", "i-1", "i-2"] and not failed
+    assert all(member.stage == "running" for member in succeeded)
+    assert fleet.members[0].instance["PublicDnsName"] == "i-0.example.com"
+    # running instances are described once and not polled any more
+    assert sorted(sum(ec2.described, [])) == ["i-0", "i-1", "i-2"]
+    assert ec2.polled[-1] == ["i-0"]
+
+
+def test_failing_to_tag_fails_only_that_instance():
+    ec2 = FakeEC2({"i-0": ["running"], "i-1": ["running"]})
+    tagged = []
+
+    def tag(index, instance):
+        if index == 1:
+            raise Exception("tagging failed")
+        tagged.append(instance["InstanceId"])
+
+    succeeded, failed = Fleet(launched("i-0", "i-1"), ec2.states, ec2.describe, tag=tag, interval=INTERVAL,
+                              timeout=10).run()
+
+    assert ids(succeeded) == ["i-0"] and tagged == ["i-0"]
+    assert ids(failed) == ["i-1"]
+    assert failed[0].stage == "launched" and str(failed[0].error) == "tagging failed"
+    assert all("i-1" not in polled for polled in ec2.polled)
+
+
+def test_instances_that_cant_run_fail():
+    ec2 = FakeEC2({"i-0": ["pending", "running"], "i-1": ["pending", "terminated"]})
+
+    succeeded, failed = Fleet(launched("i-0", "i-1"), ec2.states, ec2.describe, interval=INTERVAL, timeout=10).run()
+
+    assert ids(succeeded) == ["i-0"]
+    assert ids(failed) == ["i-1"] and str(failed[0].error) == "instance is terminated"
+    assert ec2.described == [["i-0"]]
+
+
+def test_instances_not_running_in_time_fail():
+    ec2 = FakeEC2({"i-0": ["running"], "i-1": ["pending"]})
+    started = time.monotonic()
+
+    succeeded, failed = Fleet(launched("i-0", "i-1"), ec2.states, ec2.describe, interval=INTERVAL,
+                              timeout=0.5).run()
+
+    assert 0.5 <= time.monotonic() - started < 5
+    assert ids(succeeded) == ["i-0"]
+    assert ids(failed) == ["i-1"] and str(failed[0].error) == "instance is still pending after 0.5 seconds"
+
+
+def test_without_waiting_instances_end_up_tagged():
+    ec2 = FakeEC2({"i-0": ["pending"]})
+    fleet = Fleet(launched("i-0"), ec2.states, ec2.describe, tag=lambda index, instance: None, wait=False,
+                  interval=INTERVAL, timeout=10)
+
+    succeeded, failed = fleet.run()
+
+    assert fleet.target == "tagged"
+    assert ids(succeeded) == ["i-0"] and not failed
+    assert succeeded[0].stage == "tagged"
+    assert not ec2.polled and not ec2.described
@@ -0,0 +1,298 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from decimal import Decimal
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from eyws import parser
+
+
+def ec2_client(region="us-east-1"):
+    return boto3.client("ec2", region_name=region, aws_access_key_id="test", aws_secret_access_key="test")
+
+
+def page(*instance_ids, token=None):
+    resp = {"Reservations": [{"Instances": [{"InstanceId": instance_id} for instance_id in instance_ids]}]}
+    if token:
+        resp["NextToken"] = token
+    return resp
+
+
+class StubbedClients:
+    """ClientFactory handing out a stubbed ec2 client per region"""
+
+    def __init__(self) -> None:
+        self.stubbers = {}
+
+    def stub(self, region):
+        client = ec2_client(region)
+        self.stubbers[region] = Stubber(client)
+        return self.stubbers[region]
+
+    def client(self, service, profile=None, region=None):
+        stubber = self.stubbers[region]
+        stubber.activate()
+        return stubber.client
+
+
+def test_iter_instances_follows_next_token():
+    ec2 = ec2_client()
+    filters = [{"Name": "instance-state-name", "Values": ["running"]}]
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_instances", page("i-1", "i-2", token="t1"),
+                             {"Filters": filters, "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE})
+        stubber.add_response("describe_instances", page("i-3", token="t2"),
+                             {"Filters": filters, "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE,
+                              "NextToken": "t1"})
+        stubber.add_response("describe_instances", page(),
+                             {"Filters": filters, "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE,
+                              "NextToken": "t2"})
+
+        instance_ids = [instance["InstanceId"] for instance in parser.describe_all_instances(ec2, filters)]
+
+        assert instance_ids == ["i-1", "i-2", "i-3"]
+        stubber.assert_no_pending_responses()
+
+
+def test_iter_instances_by_ids_doesnt_page_by_size():
+    ec2 = ec2_client()
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_instances", page("i-1"), {"InstanceIds": ["i-1"]})
+
+        assert [instance["InstanceId"] for instance in parser.describe_instances(ec2, ["i-1"])] == ["i-1"]
+
+
+def test_describe_instances_in_regions_yields_regions_in_order():
+    clients = StubbedClients()
+    clients.stub("us-west-2").add_response("describe_instances", page("i-w1"))
+    clients.stub("eu-west-1").add_response("describe_instances", page("i-e1", token="t"))
+    clients.stubbers["eu-west-1"].add_response("describe_instances", page("i-e2"))
+    clients.stub("ap-south-1").add_response("describe_instances", page())
+
+    instances = parser.describe_instances_in_regions(clients, None, ["us-west-2", "eu-west-1", "ap-south-1"])
+
+    assert [(region, instance["InstanceId"]) for region, instance in instances] == \
+        [("eu-west-1", "i-e1"), ("eu-west-1", "i-e2"), ("us-west-2", "i-w1")]
+    for stubber in clients.stubbers.values():
+        stubber.assert_no_pending_responses()
+
+
+def test_describe_instances_in_regions_skips_failing_regions(capsys):
+    clients = StubbedClients()
+    clients.stub("eu-west-1").add_client_error("describe_instances", "UnauthorizedOperation")
+    clients.stub("us-east-1").add_response("describe_instances", page("i-1"))
+
+    instances = list(parser.describe_instances_in_regions(clients, None, ["eu-west-1", "us-east-1"]))
+
+    assert [(region, instance["InstanceId"]) for region, instance in instances] == [("us-east-1", "i-1")]
+    assert "eu-west-1" in capsys.readouterr().err
+
+
+@pytest.mark.parametrize("tags,expected", [
+    (["env=prod"], [{"Name": "tag:env", "Values": ["prod"]}]),
+    (["env=prod", "env=dev", "owner"], [{"Name": "tag-key", "Values": ["owner"]},
+                                        {"Name": "tag:env", "Values": ["prod", "dev"]}]),
+])
+def test_instance_filters_of_tags(tags, expected):
+    opts, _ = parser.parse_args(["list-instances"] + ["--tag={}".format(tag) for tag in tags])
+    assert parser.instance_filters(opts) == expected
+
+
+def test_instance_filters_of_state_type_and_zone():
+    opts, _ = parser.parse_args(["list-instances", "--state=running", "--state=stopped", "-t", "m5.large",
+                                 "-z", "eu-west-1a", "--tag=Name=ci-*"])
+    assert parser.instance_filters(opts) == [{"Name": "instance-state-name", "Values": ["running", "stopped"]},
+                                             {"Name": "instance-type", "Values": ["m5.large"]},
+                                             {"Name": "availability-zone", "Values": ["eu-west-1a"]},
+                                             {"Name": "tag:Name", "Values": ["ci-*"]}]
+
+
+def test_instance_filters_reject_tags_without_a_key():
+    opts, _ = parser.parse_args(["list-instances", "--tag==prod"])
+    with pytest.raises(ValueError):
+        parser.instance_filters(opts)
+
+
+def cost_period(start, *groups):
+    return {"TimePeriod": {"Start": start, "End": start}, "Total": {},
+            "Groups": [{"Keys": [account, service], "Metrics": {"BlendedCost": {"Amount": amount, "Unit": "USD"}}}
+                       for account, service, amount in groups]}
+
+
+def test_merged_cost_reports_sum_the_periods_of_all_profiles(monkeypatch):
+    from eyws.accounts import AccountDirectory
+
+    results = {
+        "org1": (None, [cost_period("2026-09-01", ("111", "EC2", "1.00")),
+                        cost_period("2026-08-01", ("111", "EC2", "0.50"))], AccountDirectory({"111": "one"})),
+        "org2": (None, [cost_period("2026-09-01", ("222", "EC2", "1.50"), ("222", "S3", "0.505"))],
+                 AccountDirectory({"222": "two"})),
+    }
+    monkeypatch.setattr(parser, "get_profile_cost_periods", lambda clients, profile, cache, opts: results[profile])
+    opts, _ = parser.parse_args(["list-costs", "--profile=org1,org2", "--merge"])
+
+    reports = parser.get_cost_reports(None, None, opts)
+
+    assert len(reports) == 1
+    assert [(costs.period, costs.total) for costs in reports[0].costs] == \
+        [("September 2026", Decimal("3.01")), ("August 2026", Decimal("0.50"))]
+    assert reports[0].costs[0].account_total == {"one": Decimal("1.00"), "two": Decimal("2.01")}
+    # the periods of each profile are left alone
+    assert len(results["org1"][1][0]["Groups"]) == 1
+
+
+def instance(instance_id, state="running"):
+    return {"InstanceId": instance_id, "State": {"Name": state}}
+
+
+def ssh_opts(*args):
+    opts, _ = parser.parse_args(["exec", "-i", "key.pem", "-u", "ubuntu"] + list(args) + ["--", "uptime"])
+    return opts
+
+
+def test_ssh_instances_of_ids_keep_only_those_matching_the_filters(capsys):
+    ec2 = ec2_client()
+    opts = ssh_opts("--instance-id=i-1", "--instance-id=i-2", "--instance-id=i-3", "--tag=env=prod")
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_instances",
+                             {"Reservations": [{"Instances": [instance("i-1"), instance("i-3", "stopped")]}]},
+                             {"InstanceIds": ["i-1", "i-2", "i-3"],
+                              "Filters": [{"Name": "tag:env", "Values": ["prod"]}]})
+
+        running, skipped = parser.ssh_instances(ec2, None, None, opts, "run commands on")
+
+    assert [i["InstanceId"] for i in running] == ["i-1"]
+    assert [i["InstanceId"] for i in skipped] == ["i-3"]
+    err = capsys.readouterr().err
+    assert "i-2 doesn't match the filters, not going to run commands on it" in err
+    assert "i-3" in err and "stopped" in err
+
+
+def test_ssh_instances_fail_when_none_of_them_is_running(capsys):
+    ec2 = ec2_client()
+    with Stubber(ec2) as stubber:
+        stubber.add_response("describe_instances", {"Reservations": [{"Instances": [instance("i-1", "stopped")]}]},
+                             {"InstanceIds": ["i-1"]})
+
+        with pytest.raises(Exception, match="1 instances are not running"):
+            parser.ssh_instances(ec2, None, None, ssh_opts("--instance-id=i-1"), "push files to")
+
+    assert "No running instances to push files to." in capsys.readouterr().out
+
+
+def change_opts(*args):
+    opts, _ = parser.parse_args(["stop-instances", "--parallel=1"] + list(args))
+    return opts
+
+
+def state_changes(*instance_ids):
+    return {"StoppingInstances": [{"InstanceId": instance_id, "PreviousState": {"Code": 16, "Name": "running"},
+                                   "CurrentState": {"Code": 64, "Name": "stopping"}} for instance_id in instance_ids]}
+
+
+def test_change_instance_states_in_chunks_per_region(tmp_path, capsys):
+    from eyws.cache import Cache
+
+    clients = StubbedClients()
+    ec2 = clients.stub("us-east-1")
+    ec2.add_response("describe_regions", {"Regions": [{"RegionName": "us-east-1"}, {"RegionName": "eu-west-1"}]})
+    eu = clients.stub("eu-west-1")
+    # without --state only instances the change applies to are targeted
+    filters = [{"Name": "tag:env", "Values": ["ci"]},
+               {"Name": "instance-state-name", "Values": parser.STATE_CHANGES["stop"][2]}]
+    eu_ids = ["i-eu{}".format(i) for i in range(250)]
+    eu.add_response("describe_instances", {"Reservations": [{"Instances": [instance(i) for i in eu_ids]}]},
+                    {"Filters": filters, "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE})
+    ec2.add_response("describe_instances", {"Reservations": [{"Instances": [instance("i-us")]}]},
+                     {"Filters": filters, "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE})
+    for chunk in [eu_ids[:100], eu_ids[100:200], eu_ids[200:]]:
+        eu.add_response("stop_instances", state_changes(*chunk), {"InstanceIds": chunk, "DryRun": False})
+    ec2.add_response("stop_instances", state_changes("i-us"), {"InstanceIds": ["i-us"], "DryRun": False})
+
+    opts = change_opts("--tag=env=ci", "--all-regions", "--yes")
+    parser.change_instance_states(clients.client("ec2", None, "us-east-1"), clients, Cache(str(tmp_path)), opts,
+                                  "stop")
+
+    for stubber in clients.stubbers.values():
+        stubber.assert_no_pending_responses()
+    assert "Stopping 251 instances..." in capsys.readouterr().out
+
+
+def test_change_instance_states_keeps_the_given_state_filter():
+    clients = StubbedClients()
+    ec2 = clients.stub("us-east-1")
+    ec2.add_response("describe_instances", {"Reservations": [{"Instances": [instance("i-1", "pending")]}]},
+                     {"Filters": [{"Name": "instance-state-name", "Values": ["pending"]}],
+                      "MaxResults": parser.DESCRIBE_INSTANCES_PAGE_SIZE})
+    ec2.add_response("stop_instances", state_changes("i-1"), {"InstanceIds": ["i-1"], "DryRun": False})
+
+    opts = change_opts("--state=pending", "--yes")
+    parser.change_instance_states(clients.client("ec2", None, "us-east-1"), clients, None, opts, "stop")
+
+    ec2.assert_no_pending_responses()
+
+
+def test_change_instance_states_of_ids_only_changes_those_matching_the_filters(capsys):
+    clients = StubbedClients()
+    ec2 = clients.stub("us-east-1")
+    ec2.add_response("describe_instances", {"Reservations": [{"Instances": [instance("i-1")]}]},
+                     {"InstanceIds": ["i-1", "i-2"], "Filters": [{"Name": "tag:env", "Values": ["ci"]}]})
+    ec2.add_response("stop_instances", state_changes("i-1"), {"InstanceIds": ["i-1"], "DryRun": False})
+
+    opts = change_opts("--instance-id=i-1", "--instance-id=i-2", "--tag=env=ci", "--yes")
+    parser.change_instance_states(clients.client("ec2", None, "us-east-1"), clients, None, opts, "stop")
+
+    ec2.assert_no_pending_responses()
+    assert "i-2 doesn't match the filters, not going to stop it" in capsys.readouterr().err
+
+
+def test_change_instance_states_goes_on_after_a_failing_chunk(capsys):
+    clients = StubbedClients()
+    ec2 = clients.stub("us-east-1")
+    instance_ids = ["i-{}".format(i) for i in range(150)]
+    ec2.add_client_error("stop_instances", "IncorrectInstanceState", expected_params={
+        "InstanceIds": instance_ids[:100], "DryRun": False})
+    ec2.add_response("stop_instances", state_changes(*instance_ids[100:]),
+                     {"InstanceIds": instance_ids[100:], "DryRun": False})
+
+    opts = change_opts("--yes", *["--instance-id={}".format(instance_id) for instance_id in instance_ids])
+    with pytest.raises(Exception, match="failed to stop 100 of 150 instances"):
+        parser.change_instance_states(clients.client("ec2", None, "us-east-1"), clients, None, opts, "stop")
+
+    ec2.assert_no_pending_responses()
+    out, err = capsys.readouterr()
+    assert "failed to stop 100 instances in us-east-1" in err
+    assert "instanceId=i-149" in out
+
+
+def test_change_instance_states_refuses_to_ask_without_a_terminal(monkeypatch):
+    import io
+
+    monkeypatch.setattr("sys.stdin", io.StringIO("y\n"))
+    ec2 = ec2_client()
+    with Stubber(ec2) as stubber:
+        with pytest.raises(Exception, match="use --yes to terminate instances"):
+            parser.change_instance_states(ec2, None, None, change_opts("--instance-id=i-1"), "terminate")
+
+        stubber.assert_no_pending_responses()
+
+
+def test_all_regions_cant_be_combined_with_instance_ids(capsys):
+    with pytest.raises(SystemExit):
+        parser.execute(["terminate-instances", "--all-regions", "--instance-id=i-1", "--yes"])
+
+    assert "--all-regions can't be combined with --instance-id" in capsys.readouterr().err
@@ -0,0 +1,70 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import socket
+import threading
+import time
+
+import pytest
+
+from eyws import probe
+
+LISTEN_DELAY = 0.5
+
+
+@pytest.fixture
+def late_port():
+    """Port on 127.0.0.1 that starts accepting connections LISTEN_DELAY seconds from now"""
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(("127.0.0.1", 0))
+    port = server.getsockname()[1]
+
+    def listen():
+        time.sleep(LISTEN_DELAY)
+        server.listen(8)
+
+    threading.Thread(target=listen, daemon=True).start()
+    yield port
+    server.close()
+
+
+@pytest.fixture
+def closed_port():
+    """Port on 127.0.0.1 nothing listens on"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def test_wait_for_returns_once_the_port_listens(late_port):
+    started = time.monotonic()
+    assert probe.wait_for("127.0.0.1", late_port, interval=0.1, timeout=10)
+    assert LISTEN_DELAY <= time.monotonic() - started < 5
+
+
+def test_wait_for_gives_up_after_timeout(closed_port):
+    started = time.monotonic()
+    assert not probe.wait_for("127.0.0.1", closed_port, interval=0.1, timeout=0.5)
+    assert 0.5 <= time.monotonic() - started < 5
+
+
+def test_as_ready_yields_hosts_as_they_come_up(late_port):
+    # 127.0.0.2 is loopback as well, but nothing listens on it
+    hosts = {"never": "127.0.0.2", "late": "127.0.0.1"}
+    started = time.monotonic()
+    ready = list(probe.as_ready(hosts, address=hosts.get, port=late_port, interval=0.1, timeout=1.5))
+
+    assert ready == [("late", True), ("never", False)]
+    assert time.monotonic() - started < 5
@@ -0,0 +1,124 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import getpass
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from eyws import probe, ssh
+
+SSHD = shutil.which("sshd") or next((path for path in ["/usr/sbin/sshd", "/usr/local/sbin/sshd"]
+                                     if os.path.exists(path)), None)
+
+
+def test_check_call_streamed_returns_while_a_forked_child_holds_the_pipe():
+    # like a ControlPersist master, the background sleep inherits stdout and keeps it open after sh exits
+    lines = []
+    started = time.monotonic()
+    ssh.check_call_streamed(["sh", "-c", "echo one; echo two; sleep 30 & exit 0"], lines.append)
+
+    assert lines == ["one", "two"]
+    assert time.monotonic() - started < 10
+
+
+def test_check_call_streamed_raises_with_the_exit_code():
+    lines = []
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        ssh.check_call_streamed(["sh", "-c", "cat; exit 3"], lines.append, stdin="fed\n")
+
+    assert e.value.returncode == 3
+    assert lines == ["fed"]
+
+
+def test_ssh_feeds_stdin_to_the_remote_command_without_a_prefix(monkeypatch, capfd):
+    # sh stands in for ssh, it gets user@host as $0 and the remote command as $1
+    monkeypatch.setattr(ssh, "ssh_command", lambda opts, control_path=None: ["sh", "-c", 'echo "$@"; cat'])
+    opts = SimpleNamespace(user="ubuntu", ssh_max_wait=1)
+
+    ssh.ssh("host", opts, "sh -s", stdin="echo from the script\n")
+
+    assert capfd.readouterr().out == "sh -s\necho from the script\n"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture
+def sshd(tmp_path):
+    """(port, identity) of a private sshd on localhost letting the current user in with a fresh key"""
+    if SSHD is None:
+        pytest.skip("sshd is not installed")
+
+    host_key = str(tmp_path / "host_key")
+    identity = str(tmp_path / "id")
+    for key in [host_key, identity]:
+        subprocess.check_call(["ssh-keygen", "-q", "-t", "ed25519", "-N", "", "-f", key])
+    shutil.copy(identity + ".pub", str(tmp_path / "authorized_keys"))
+
+    port = free_port()
+    config = tmp_path / "sshd_config"
+    config.write_text("\n".join(["ListenAddress 127.0.0.1",
+                                 "HostKey {}".format(host_key),
+                                 "AuthorizedKeysFile {}".format(tmp_path / "authorized_keys"),
+                                 "PidFile {}".format(tmp_path / "sshd.pid"),
+                                 "StrictModes no",
+                                 "UsePAM no",
+                                 "PasswordAuthentication no"]) + "\n")
+
+    proc = subprocess.Popen([SSHD, "-D", "-e", "-f", str(config), "-p", str(port)],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not probe.wait_for("127.0.0.1", port, interval=0.1, timeout=10):
+            pytest.skip("sshd didn't start")
+        yield port, identity
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def test_session_runs_commands_over_one_master_connection(sshd, monkeypatch):
+    port, identity = sshd
+    ssh_args = ssh.ssh_args
+    monkeypatch.setattr(ssh, "ssh_args", lambda *args, **kwargs: ssh_args(*args, **kwargs) + ["-p", str(port)])
+    opts = SimpleNamespace(user=getpass.getuser(), identity=identity, ssh_timeout=5, ssh_max_wait=5)
+
+    lines = []
+    session = ssh.Session("127.0.0.1", opts)
+
+    def run():
+        session.run("echo first", stdin="", on_line=lines.append)
+        assert os.path.exists(session.control_path)
+        session.run("echo second", stdin="", on_line=lines.append)
+
+    # both runs have to return although the master connection lives on in the background
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    runner.join(30)
+    try:
+        assert not runner.is_alive()
+        assert lines == ["first", "second"]
+    finally:
+        session.close()
+
+    assert not os.path.exists(session.control_dir)
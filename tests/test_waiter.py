@@ -0,0 +1,98 @@
+# Copyright 2018 Can Elmas
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#    http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+from botocore.stub import Stubber
+
+from eyws.waiter import MAX_STATUS_IDS, as_reached, visible_states
+
+INTERVAL = 0.01
+STATE_CODES = {"pending": 0, "running": 16, "shutting-down": 32, "terminated": 48, "stopping": 64, "stopped": 80}
+
+
+@pytest.fixture
+def stubbed():
+    ec2 = boto3.client("ec2", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test")
+    with Stubber(ec2) as stubber:
+        yield ec2, stubber
+        stubber.assert_no_pending_responses()
+
+
+def statuses(states):
+    return {"InstanceStatuses": [{"InstanceId": instance_id,
+                                  "InstanceState": {"Code": STATE_CODES[state], "Name": state}}
+                                 for instance_id, state in states.items()]}
+
+
+def status_params(*instance_ids):
+    return {"InstanceIds": list(instance_ids), "IncludeAllInstances": True}
+
+
+def test_visible_states_polls_in_batches(stubbed):
+    ec2, stubber = stubbed
+    instance_ids = ["i-{}".format(i) for i in range(MAX_STATUS_IDS + 1)]
+    stubber.add_response("describe_instance_status", statuses({"i-0": "running"}), status_params(*instance_ids[:-1]))
+    stubber.add_response("describe_instance_status", statuses({instance_ids[-1]: "pending"}),
+                         status_params(instance_ids[-1]))
+
+    assert visible_states(ec2, instance_ids) == {"i-0": "running", instance_ids[-1]: "pending"}
+
+
+def test_visible_states_leaves_out_batches_not_found_yet(stubbed):
+    ec2, stubber = stubbed
+    instance_ids = ["i-{}".format(i) for i in range(MAX_STATUS_IDS + 1)]
+    stubber.add_client_error("describe_instance_status", "InvalidInstanceID.NotFound",
+                             expected_params=status_params(*instance_ids[:-1]))
+    stubber.add_response("describe_instance_status", statuses({instance_ids[-1]: "pending"}),
+                         status_params(instance_ids[-1]))
+
+    assert visible_states(ec2, instance_ids) == {instance_ids[-1]: "pending"}
+
+
+def test_visible_states_raises_other_errors(stubbed):
+    ec2, stubber = stubbed
+    stubber.add_client_error("describe_instance_status", "UnauthorizedOperation")
+
+    with pytest.raises(ClientError):
+        visible_states(ec2, ["i-1"])
+
+
+def test_as_reached_yields_instances_as_they_reach_the_state_or_cant(stubbed):
+    ec2, stubber = stubbed
+    stubber.add_response("describe_instance_status",
+                         statuses({"i-1": "pending", "i-2": "terminated", "i-3": "running"}),
+                         status_params("i-1", "i-2", "i-3"))
+    stubber.add_response("describe_instance_status", statuses({"i-1": "running"}), status_params("i-1"))
+
+    assert list(as_reached(ec2, ["i-1", "i-2", "i-3"], "instance_running", INTERVAL, timeout=10)) == \
+        [("i-2", "terminated"), ("i-3", "running"), ("i-1", "running")]
+
+
+def test_as_reached_polls_instances_not_found_again(stubbed):
+    ec2, stubber = stubbed
+    stubber.add_client_error("describe_instance_status", "InvalidInstanceID.NotFound",
+                             expected_params=status_params("i-1"))
+    stubber.add_response("describe_instance_status", statuses({"i-1": "running"}), status_params("i-1"))
+
+    assert list(as_reached(ec2, ["i-1"], "instance_running", INTERVAL, timeout=10)) == [("i-1", "running")]
+
+
+def test_as_reached_yields_the_last_known_state_after_timeout(stubbed):
+    ec2, stubber = stubbed
+    stubber.add_response("describe_instance_status", statuses({"i-1": "pending"}), status_params("i-1", "i-2"))
+
+    assert list(as_reached(ec2, ["i-1", "i-2"], "instance_running", INTERVAL, timeout=0)) == \
+        [("i-1", "pending"), ("i-2", None)]